@@ -3,12 +3,912 @@ Computer Vision Module
 """
 
 import cv2, cv
+from collections import OrderedDict
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import threading
+import time
+import os
+import recorder
+import sources
+
+## Percentile
+"""
+Linearly interpolated percentile along an axis, as np.percentile,
+but selecting the two neighbouring ranks with np.partition instead of sorting
+If out is given, the values are copied into it and partitioned in place
+"""
+def partition_percentile(values, q, axis=-1, out=None):
+    n = values.shape[axis]
+    rank = (n - 1) * q / 100.0
+    lo = int(np.floor(rank))
+    hi = min(lo + 1, n - 1)
+    if out is None:
+        part = np.partition(values, (lo, hi), axis=axis)
+    else:
+        np.copyto(out, values)
+        out.partition((lo, hi), axis=axis)
+        part = out
+    v_lo = np.take(part, lo, axis=axis).astype(np.float64)
+    v_hi = np.take(part, hi, axis=axis).astype(np.float64)
+    return v_lo + (v_hi - v_lo) * (rank - lo)
+
+class FrameGrabber(threading.Thread):
+    """
+    Background reader for a single capture interface
+    1. Reads frames from the camera as fast as the driver delivers them
+    2. Keeps only the newest frame, with its capture timestamp and sequence number
+    3. Counts frames which were overwritten before anyone consumed them
+    """
+
+    def __init__(self, camera, cam_num=0, recorder=None):
+        threading.Thread.__init__(self, name='grabber-%d' % cam_num)
+        self.daemon = True
+        self.camera = camera
+        self.cam_num = cam_num
+        self.recorder = recorder
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.waited = False # the first call to latest() has waited for the first frame
+        self.running = False
+        self.frame = None
+        self.timestamp = None
+        self.sequence = 0 # number of frames grabbed so far
+        self.consumed = 0 # sequence number of the last frame handed out
+        self.dropped = 0 # frames replaced before they were consumed
+        self.repeated = 0 # frames handed out more than once
+        self.failures = 0 # unsuccessful reads
+
+    def run(self):
+        self.running = True
+        while self.running:
+            (s, bgr) = self.camera.read()
+            t = time.time()
+            if not s:
+                self.failures += 1
+                time.sleep(0.01)
+                continue
+            with self.lock:
+                if self.sequence > self.consumed:
+                    self.dropped += 1
+                self.frame = bgr
+                self.timestamp = t
+                self.sequence += 1
+                sequence = self.sequence
+            self.ready.set()
+            if self.recorder is not None:
+                self.recorder.write(bgr, t, sequence)
+
+    ## Latest Frame
+    """
+    1. On the first call only, wait up to timeout for the first frame; never wait for a new one
+    2. Returns (bgr, timestamp, sequence) of the newest frame, or (None, None, 0)
+       if the camera has not delivered any yet
+    """
+    def latest(self, timeout=1.0):
+        if not self.waited:
+            self.ready.wait(timeout)
+            self.waited = True
+        with self.lock:
+            if self.frame is not None and self.sequence == self.consumed:
+                self.repeated += 1
+            self.consumed = self.sequence
+            return (self.frame, self.timestamp, self.sequence)
+
+    def get_stats(self):
+        return {
+            'grabbed' : self.sequence,
+            'dropped' : self.dropped,
+            'repeated' : self.repeated,
+            'failures' : self.failures
+        }
+
+    def stop(self, timeout=1.0):
+        self.running = False
+        if self.is_alive():
+            self.join(timeout)
+
+class FrameBuffers:
+    """
+    Named work buffers of one camera, reused from frame to frame
+    1. A buffer is allocated on first use, or when the frame size changes
+    2. Every allocation is counted, so a steady-state loop adds none
+    """
+
+    def __init__(self, width=640, height=480):
+        self.buffers = {}
+        self.allocations = 0
+        self.get('mask', (height, width))
+        self.get('column_sum', (1, width), np.int32)
+        self.get('profile', (width,), np.int32)
+
+    def get(self, name, shape, dtype=np.uint8):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[name] = np.empty(shape, dtype)
+            self.allocations += 1
+        return buf
+
+    def get_stats(self):
+        return {
+            'buffers' : len(self.buffers),
+            'allocations' : self.allocations,
+            'bytes' : sum(b.nbytes for b in self.buffers.values())
+        }
+
+class StripePool:
+    """
+    Thread pool running a function over horizontal stripes of a frame
+    1. The rows are split into STRIPES contiguous bands, each a view of the frame
+    2. fn(stripe, top, bottom) runs on every band in parallel, as OpenCV and NumPy
+       release the GIL, and the results are returned in stripe order
+    3. With one stripe, or a frame below MIN_PIXELS, fn runs on the calling thread
+    The pool is started on first use in each process, so it survives the fork of a VisionWorker
+    """
+
+    def __init__(self, stripes=1, min_pixels=1 << 17):
+        self.STRIPES = max(1, stripes)
+        self.MIN_PIXELS = min_pixels
+        self.pool = None
+        self.pid = None
+        self.bands = {}
+        self.runs = 0
+
+    def get_bands(self, height):
+        bands = self.bands.get(height)
+        if bands is None:
+            edges = [height * i // self.STRIPES for i in range(self.STRIPES + 1)]
+            bands = self.bands[height] = [(i, edges[i], edges[i + 1]) for i in range(self.STRIPES)]
+        return bands
+
+    ## Run
+    """
+    Returns [fn(stripe, top, bottom) for every stripe], or None if the frame is not striped
+    """
+    def run(self, fn, height, width=1):
+        if self.STRIPES == 1 or height * width < self.MIN_PIXELS:
+            return None
+        if self.pid != os.getpid():
+            (self.pool, self.pid) = (ThreadPool(self.STRIPES), os.getpid())
+        self.runs += 1
+        return self.pool.map(lambda band: fn(*band), self.get_bands(height), 1)
+
+    def close(self):
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+class ColourTable:
+    """
+    Quantised BGR-to-mask lookup table
+    1. Every quantised BGR colour is converted to HSV once (cached on disk)
+    2. A table is compiled for each set of thresholds (cached on disk and in memory)
+    3. A frame is classified by packing its pixels into table indices and one lookup
+    Tables are stored compact (B, G, R order) and looked up through a sparse
+    copy indexed by the quantised channels in their own bytes, B | G << 8 | R << 16,
+    which a frame packs into with one shift and one mask of its 32-bit pixels
+    """
+
+    def __init__(self, bits=5, cache_dir='cache', cache_size=4):
+        if not 4 <= bits <= 7:
+            raise ValueError('bits must be between 4 and 7')
+        self.BITS = bits
+        self.SHIFT = 8 - bits
+        self.CACHE_DIR = cache_dir
+        self.CACHE_SIZE = cache_size # sparse tables kept in memory
+        self.INDEX_TYPE = np.intp
+        self.LANE_MASK = ((1 << bits) - 1) * 0x010101
+        levels = np.arange(1 << bits)
+        (b, g, r) = np.meshgrid(levels, levels, levels, indexing='ij')
+        self.positions = (b | g << 8 | r << 16).ravel()
+        self.cube = self.load('hsv_cube_b%d' % bits, self.build_cube)
+        self.sat_cube = self.expand(self.cube[:,1])
+        self.val_cube = self.expand(self.cube[:,2])
+        self.tables = {}
+        self.sparse_tables = OrderedDict()
+
+    ## Load or Build
+    """
+    1. Load the named array from the cache directory
+    2. Otherwise build it and try to save it for the next start-up
+    """
+    def load(self, name, build):
+        path = os.path.join(self.CACHE_DIR, name + '.npy')
+        try:
+            return np.load(path)
+        except (IOError, ValueError):
+            pass
+        array = build()
+        try:
+            if not os.path.isdir(self.CACHE_DIR):
+                os.makedirs(self.CACHE_DIR)
+            np.save(path, array)
+        except (IOError, OSError) as error:
+            print('\tERROR in ColourTable.load(): %s' % str(error))
+        return array
+
+    ## HSV Cube
+    """
+    1. Take the centre of each quantised BGR bin, in compact index order (B, G, R)
+    2. Convert all of them to HSV in a single call
+    """
+    def build_cube(self):
+        levels = (np.arange(1 << self.BITS) << self.SHIFT) + (1 << self.SHIFT) // 2
+        (b, g, r) = np.meshgrid(levels, levels, levels, indexing='ij')
+        bgr = np.dstack((b.ravel(), g.ravel(), r.ravel())).astype(np.uint8)
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+
+    def build_table(self, hue_min, hue_max, sat_min, sat_max, val_min, val_max):
+        (h, s, v) = (self.cube[:,0], self.cube[:,1], self.cube[:,2])
+        selected = (h >= hue_min) & (h <= hue_max) & (s >= sat_min) & (s <= sat_max) & (v >= val_min) & (v <= val_max)
+        return np.where(selected, 255, 0).astype(np.uint8)
+
+    ## Expand Table
+    """
+    Scatter a compact table into its sparse lookup layout (unused entries are 0)
+    An evicted sparse table can be passed in, its unused entries are still 0
+    """
+    def expand(self, compact, sparse=None):
+        if sparse is None:
+            sparse = np.zeros(self.LANE_MASK + 1, compact.dtype)
+        sparse[self.positions] = compact
+        return sparse
+
+    ## Compile Table
+    """
+    1. Adaptive minimums are quantised to the table resolution
+    2. Compact tables are only rebuilt when the thresholds change
+    3. The last CACHE_SIZE sparse tables are kept, and the oldest one is
+       overwritten by the next new table
+    """
+    def compile(self, hue_min, hue_max, sat_min, sat_max, val_min, val_max):
+        step = 1 << self.SHIFT
+        key = (int(hue_min), int(hue_max), int(sat_min) // step * step, int(sat_max), int(val_min) // step * step, int(val_max))
+        sparse = self.sparse_tables.pop(key, None)
+        if sparse is None:
+            table = self.tables.get(key)
+            if table is None:
+                name = 'lut_b%d_h%d-%d_s%d-%d_v%d-%d' % ((self.BITS,) + key)
+                table = self.load(name, lambda: self.build_table(*key))
+                self.tables[key] = table
+            evicted = None
+            if len(self.sparse_tables) >= self.CACHE_SIZE:
+                evicted = self.sparse_tables.popitem(last=False)[1]
+            sparse = self.expand(table, evicted)
+        self.sparse_tables[key] = sparse
+        return sparse
+
+    ## Pack Pixels
+    """
+    1. Pad BGR to BGRA, so that each pixel is one little-endian 32-bit word
+    2. Index = (word & lane mask << shift) >> shift = (B >> shift) | (G >> shift) << 8 | (R >> shift) << 16,
+       masked in 32 bits before the one pass that widens it to intp
+    Written into the given FrameBuffers, or into new arrays
+    """
+    def pack(self, bgr, buffers=None):
+        (h, w) = bgr.shape[:2]
+        if buffers is None:
+            (index, bgra) = (np.empty((h, w), self.INDEX_TYPE), np.empty((h, w, 4), np.uint8))
+        else:
+            (index, bgra) = (buffers.get('index', (h, w), self.INDEX_TYPE), buffers.get('bgra', (h, w, 4)))
+        return self.pack_into(bgr, index, bgra)
+
+    def pack_into(self, bgr, index, bgra):
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA, dst=bgra)
+        words = bgra.view('<u4')[:,:,0]
+        np.bitwise_and(words, self.LANE_MASK << self.SHIFT, out=words)
+        np.right_shift(words, self.SHIFT, out=index, casting='unsafe')
+        return index
+
+    ## Mean Saturation and Value
+    """
+    Estimated from the HSV of the quantised colours of a strided subsample
+    The subsample is copied out once, as np.take would copy strided indices on every lookup
+    Buffers are named by stride, so dense samples and probes each keep their own
+    """
+    def mean_sat_val(self, index, stride=4, buffers=None):
+        sample = index[::stride, ::stride]
+        if buffers is None:
+            (sample, out) = (np.ascontiguousarray(sample), np.empty(sample.shape, self.sat_cube.dtype))
+        else:
+            (strided, sample) = (sample, buffers.get('sample_index_%d' % stride, sample.shape, self.INDEX_TYPE))
+            np.copyto(sample, strided)
+            out = buffers.get('sample_%d' % stride, sample.shape, self.sat_cube.dtype)
+        sat = self.apply(sample, self.sat_cube, out).mean()
+        val = self.apply(sample, self.val_cube, out).mean()
+        return (sat, val)
+
+    ## Apply Table
+    """
+    One lookup over the index image, into out if given
+    Indices are always in range and already intp, so clip mode writes
+    straight into out without a copy of the indices
+    """
+    def apply(self, index, table, out=None):
+        return np.take(table, index, out=out, mode='clip')
+
+## Vegetation Indices
+"""
+Integer weights (B, G, R), bias and right shift of each index, scaled so that
+index = (wB*B + wG*G + wR*R + bias) / 2^shift fits in int16
+ExG = 2G - R - B
+ExG - ExR = 3G - 2.4R - B, with 2.4 ~ 19/8
+-CIVE = 0.811G - 0.441R - 0.385B - 18.787, scaled by 64
+"""
+VEGETATION_INDICES = {
+    'exg' : ((-1, 2, -1), 0, 0),
+    'exgr' : ((-8, 24, -19), 0, 3),
+    'cive' : ((-25, 52, -28), -1202, 6)
+}
+
+## Otsu Threshold
+"""
+Level maximising the between-class variance of a 256-bin histogram
+Accepts a single histogram or one histogram per row
+"""
+def otsu_level(hist):
+    p = hist.astype(np.float64)
+    p /= np.maximum(p.sum(axis=-1, keepdims=True), 1)
+    omega = p.cumsum(axis=-1)
+    mu = (p * np.arange(p.shape[-1])).cumsum(axis=-1)
+    mu_t = mu[..., -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_b = (mu_t * omega - mu) ** 2 / (omega * (1.0 - omega))
+    sigma_b[~np.isfinite(sigma_b)] = 0
+    return sigma_b.argmax(axis=-1)
+
+class VegetationIndex:
+    """
+    Vegetation index segmentation directly on the BGR buffer, without HSV
+    1. Saturating int16 weighted channel sum, scaled to uint8
+    2. One histogram pass, thresholded with Otsu's method
+    """
+
+    def __init__(self, mode='exg'):
+        ((self.W_B, self.W_G, self.W_R), self.BIAS, self.SHIFT) = VEGETATION_INDICES[mode]
+        self.MODE = mode
+        self.level = None
+        self.hist = None
+
+    ## Compute Index
+    """
+    1. Split the BGR image into planes
+    2. Weighted sum in int16 (exact, the weights are integers), less the bias
+    3. Negative values clipped, scaled by 2^-shift and saturated to uint8
+    Written into the given FrameBuffers, or into new arrays
+    """
+    def compute(self, bgr, buffers=None):
+        if buffers is None:
+            (b, g, r) = cv2.split(bgr)
+            (acc, scratch, index) = (None, None, None)
+        else:
+            shape = bgr.shape[:2]
+            (b, g, r) = cv2.split(bgr, [buffers.get('plane_%d' % i, shape) for i in range(3)])
+            (acc, scratch) = (buffers.get('acc', shape, np.int16), buffers.get('scratch', shape, np.int16))
+            index = buffers.get('index', shape)
+        acc = cv2.addWeighted(g, self.W_G, r, self.W_R, self.BIAS, dst=acc, dtype=cv2.CV_16S)
+        if self.W_B == -1:
+            cv2.subtract(acc, b, dst=acc, dtype=cv2.CV_16S)
+        else:
+            cv2.subtract(acc, cv2.multiply(b, -self.W_B, dst=scratch, dtype=cv2.CV_16S), dst=acc)
+        cv2.max(acc, 0, dst=acc)
+        return cv2.convertScaleAbs(acc, dst=index, alpha=1.0 / (1 << self.SHIFT))
+
+    ## Segment
+    """
+    1. Histogram of the index image (the only pass over it before thresholding)
+    2. Otsu level from the histogram, then a binary threshold
+    """
+    def segment(self, bgr, buffers=None):
+        index = self.compute(bgr, buffers)
+        (hist, mask) = (None, None) if buffers is None else (buffers.get('hist', (256, 1), np.float32), buffers.get('mask', index.shape))
+        self.hist = cv2.calcHist([index], [0], None, [256], [0, 256], hist=hist).ravel()
+        self.level = int(otsu_level(self.hist))
+        (level, mask) = cv2.threshold(index, self.level, 255, cv2.THRESH_BINARY, dst=mask)
+        return mask
+
+## Sample Saturation and Value
+"""
+Mean saturation and value of every stride-th pixel of an HSV image
+"""
+def sample_sat_val(hsv, stride=1):
+    sample = hsv[::stride, ::stride]
+    return (sample[:,:,1].mean(), sample[:,:,2].mean())
+
+class AdaptiveThreshold:
+    """
+    Running estimate of the mean saturation and value, the minimum cut-offs of the plant filter
+    1. Every frame, only a sparse probe (every PROBE_STRIDE-th pixel) is measured
+    2. Every REFRESH frames, a denser sample (every STRIDE-th pixel) is blended into
+       the estimate by an exponential moving average with weight ALPHA
+    3. If a probe or sample differs from the estimate by more than JUMP, the lighting
+       changed abruptly, and the estimate restarts from a dense sample instead
+    measure(image, stride) returns the (saturation, value) means of a subsample
+    """
+
+    def __init__(self, stride=4, probe_stride=32, alpha=0.3, refresh=10, jump=25.0):
+        self.STRIDE = stride
+        self.PROBE_STRIDE = probe_stride
+        self.ALPHA = alpha
+        self.REFRESH = refresh
+        self.JUMP = jump
+        self.sat = None
+        self.val = None
+        self.age = 0 # frames since the last dense sample
+        self.frames = 0
+        self.refreshes = 0
+        self.jumps = 0
+
+    ## Update
+    """
+    1. Probe, unless a refresh is due (or there is no estimate yet)
+    2. On a refresh or a jump, take a dense sample, then blend it in or restart from it
+    Returns the (saturation, value) estimate
+    """
+    def update(self, measure, image):
+        self.frames += 1
+        self.age += 1
+        if self.sat is not None and self.age < self.REFRESH:
+            (sat, val) = measure(image, self.PROBE_STRIDE)
+            if abs(sat - self.sat) <= self.JUMP and abs(val - self.val) <= self.JUMP:
+                return (self.sat, self.val)
+        (sat, val) = measure(image, self.STRIDE)
+        self.age = 0
+        if self.sat is None or abs(sat - self.sat) > self.JUMP or abs(val - self.val) > self.JUMP:
+            if self.sat is not None:
+                self.jumps += 1
+            (self.sat, self.val) = (sat, val)
+        else:
+            self.refreshes += 1
+            self.sat += self.ALPHA * (sat - self.sat)
+            self.val += self.ALPHA * (val - self.val)
+        return (self.sat, self.val)
+
+    def get_stats(self):
+        return {
+            'saturation' : self.sat,
+            'value' : self.val,
+            'frames' : self.frames,
+            'refreshes' : self.refreshes,
+            'jumps' : self.jumps
+        }
+
+class RegionOfInterest:
+    """
+    Search window for the crop row of one camera
+    1. A horizontal band of rows (fractions of the image height)
+    2. A window of columns centred on the previous peak (half-width as a fraction of the width)
+    3. Counts hits, misses (fallbacks to the full frame) and pixels summed
+    """
+
+    def __init__(self, band=(0.5, 1.0), window=0.125, min_confidence=1.5, margin=2):
+        self.BAND = band
+        self.WINDOW = window
+        self.MIN_CONFIDENCE = min_confidence
+        self.MARGIN = margin
+        self.center = None
+        self.geometry = None
+        self.hits = 0
+        self.misses = 0
+        self.searches = 0
+        self.pixels = 0 # pixels summed
+        self.full_pixels = 0 # pixels a full-frame search would have summed
+
+    def top(self, height):
+        return int(self.BAND[0] * height)
+
+    def bottom(self, height):
+        return int(self.BAND[1] * height)
+
+    def window(self, width):
+        half = int(self.WINDOW * width)
+        left = max(0, self.center - half)
+        right = min(width, self.center + half + 1)
+        self.geometry = (left, right)
+        return (left, right)
+
+    def hit(self, center, pixels, full_pixels):
+        self.center = center
+        self.hits += 1
+        self.pixels += pixels
+        self.full_pixels += full_pixels
+
+    def miss(self, pixels, full_pixels):
+        self.misses += 1
+        self.pixels += pixels
+
+    def reset(self, center, full_pixels):
+        self.center = center
+        self.searches += 1
+        self.pixels += full_pixels
+        self.full_pixels += full_pixels
+
+    def get_stats(self):
+        return {
+            'band' : self.BAND,
+            'window' : self.geometry,
+            'center' : self.center,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'searches' : self.searches,
+            'pixel_ratio' : float(self.pixels) / self.full_pixels if self.full_pixels else 1.0
+        }
+
+class ProfileCorrelator:
+    """
+    Tracks the crop row of one camera by FFT cross-correlation of column profiles
+    1. The reference is a running average (ALPHA) of recent zero-mean profiles, each
+       aligned to the reference before it is blended in, kept as its real FFT
+    2. Each new profile is correlated with the reference over lags up to MAX_SHIFT
+       (a fraction of the width), zero-padded so that the correlation does not wrap
+    3. The shift is refined to sub-pixel by a parabola through the peak and its neighbours
+    4. The row is at the anchor (the column of the row when the reference was started)
+       plus the shift; the reference restarts from the current profile, anchored at the
+       given column, when the normalised correlation falls below MIN_CORRELATION or the
+       peak is at the edge of the search
+    """
+
+    def __init__(self, width, alpha=0.2, max_shift=0.25, min_correlation=0.5):
+        self.ALPHA = alpha
+        self.MIN_CORRELATION = min_correlation
+        self.N = 1 << int(np.ceil(np.log2(2 * width)))
+        self.MAX_LAG = max(2, int(max_shift * width))
+        self.lags = np.arange(-self.MAX_LAG, self.MAX_LAG + 1)
+        self.search = self.lags % self.N
+        self.omega = 2 * np.pi * np.arange(self.N // 2 + 1) / self.N
+        self.weights = np.full(self.N // 2 + 1, 2.0 / self.N) # Parseval weights of the one-sided spectrum
+        self.weights[0] = 1.0 / self.N
+        self.weights[-1] = 1.0 / self.N
+        self.reference = None
+        self.anchor = None
+        self.correlation = 0.0
+        self.tracked = 0
+        self.resets = 0
+
+    def reset(self, spectrum, column):
+        self.reference = spectrum
+        self.anchor = float(column)
+        self.resets += 1
+
+    ## Track
+    """
+    1. FFT of the zero-mean profile, and the correlation with the reference
+    2. Peak within MAX_LAG, parabolic sub-pixel refinement and normalisation
+    3. Blend the profile, shifted back onto the reference, into the reference
+    Returns the column of the row (float), or the given column if the reference restarted
+    """
+    def track(self, profile, column):
+        p = profile - profile.mean()
+        spectrum = np.fft.rfft(p, self.N)
+        if self.reference is None:
+            self.reset(spectrum, column)
+            self.correlation = 1.0
+            return self.anchor
+        c = np.fft.irfft(spectrum * np.conj(self.reference), self.N)[self.search]
+        k = int(c.argmax())
+        energy = np.dot(p, p) * np.dot(self.weights, np.abs(self.reference) ** 2)
+        self.correlation = c[k] / np.sqrt(energy) if energy > 0 else 0.0
+        if self.correlation < self.MIN_CORRELATION or k == 0 or k == len(c) - 1:
+            self.reset(spectrum, column)
+            return self.anchor
+        curvature = c[k - 1] - 2 * c[k] + c[k + 1]
+        delta = 0.5 * (c[k - 1] - c[k + 1]) / curvature if curvature < 0 else 0.0
+        shift = self.lags[k] + delta
+        self.reference *= 1 - self.ALPHA
+        self.reference += self.ALPHA * spectrum * np.exp(1j * self.omega * shift)
+        self.tracked += 1
+        return self.anchor + shift
+
+    def get_stats(self):
+        return {
+            'anchor' : self.anchor,
+            'correlation' : self.correlation,
+            'tracked' : self.tracked,
+            'resets' : self.resets
+        }
+
+class PeriodicProfile:
+    """
+    Locates the crop rows of one camera as a periodic pattern in the column profile
+    1. The dominant spatial frequency is the peak of the zero-padded real FFT of the
+       zero-mean profile, between MIN_SPACING and MAX_SPACING (fractions of the width),
+       refined by a parabola through the peak bin and its neighbours
+    2. The phase is fitted by least squares to a cosine and sine of that frequency, which,
+       unlike the FFT phase, is not biased when only two or three rows are in view
+    3. Rows lie one spacing apart from the phase; the row locked on the previous frame is
+       kept until it is more than 3/4 of a spacing from the centre, then the row nearest
+       the centre is taken
+    4. Below MIN_STRENGTH (the fraction of the profile's variance explained by the fit),
+       the lock is released and the given fallback column is returned
+    """
+
+    def __init__(self, width, min_spacing=0.2, max_spacing=0.8, min_strength=0.2, pad=2, alpha=0.1):
+        self.WIDTH = width
+        self.N = 1 << int(np.ceil(np.log2(pad * width)))
+        self.K_MIN = max(1, int(np.ceil(self.N / (max_spacing * width))))
+        self.K_MAX = min(self.N // 2 - 1, int(self.N / (min_spacing * width)))
+        self.MIN_STRENGTH = min_strength
+        self.ALPHA = alpha
+        self.x = np.arange(width, dtype=np.float64)
+        self.locked = None
+        self.spacing = None # running average (px)
+        self.strength = 0.0
+        self.frames = 0
+        self.periodic = 0
+        self.switches = 0
+
+    ## Track
+    """
+    Returns the column of the locked row (float), or the fallback column if the profile is not periodic
+    """
+    def track(self, profile, fallback):
+        self.frames += 1
+        p = profile - profile.mean()
+        spectrum = np.abs(np.fft.rfft(p, self.N)[self.K_MIN - 1:self.K_MAX + 2])
+        k = int(spectrum[1:-1].argmax()) + 1
+        curvature = spectrum[k - 1] - 2 * spectrum[k] + spectrum[k + 1]
+        delta = 0.5 * (spectrum[k - 1] - spectrum[k + 1]) / curvature if curvature < 0 else 0.0
+        omega = 2 * np.pi * (self.K_MIN - 1 + k + delta) / self.N
+        (c, s) = (np.cos(omega * self.x), np.sin(omega * self.x))
+        (cc, ss, cs, pc, ps) = (np.dot(c, c), np.dot(s, s), np.dot(c, s), np.dot(p, c), np.dot(p, s))
+        det = cc * ss - cs * cs
+        energy = np.dot(p, p)
+        if det <= 0 or energy <= 0:
+            self.strength = 0.0
+            self.locked = None
+            return float(fallback)
+        (a, b) = ((ss * pc - cs * ps) / det, (cc * ps - cs * pc) / det)
+        self.strength = (a * pc + b * ps) / energy
+        if self.strength < self.MIN_STRENGTH:
+            self.locked = None
+            return float(fallback)
+        period = 2 * np.pi / omega
+        first = np.arctan2(b, a) / omega
+        center = self.WIDTH / 2.0
+        target = self.locked if self.locked is not None and abs(self.locked - center) <= 0.75 * period else center
+        column = first + np.round((target - first) / period) * period
+        if self.locked is not None and target == center:
+            self.switches += 1
+        self.locked = column
+        self.spacing = period if self.spacing is None else self.spacing + self.ALPHA * (period - self.spacing)
+        self.periodic += 1
+        return column
+
+    def get_stats(self):
+        return {
+            'spacing' : self.spacing,
+            'strength' : self.strength,
+            'frames' : self.frames,
+            'periodic' : self.periodic,
+            'switches' : self.switches
+        }
+
+class LineFitter:
+    """
+    Fits crop lines x = slope * y + intercept to a mask by RANSAC
+    1. Sparse sample: the plant pixels of every STRIDE-th row and column
+    2. All hypotheses (lines through random point pairs) are scored at once,
+       as a hypotheses x points matrix of residuals
+    3. The best one is refined by least squares on its inliers, which are
+       removed before searching for the next row
+    Lines are returned as (offset, angle, confidence), nearest the centre first
+    1. offset: lateral offset at the bottom of the image (px)
+    2. angle: heading of the row relative to the image vertical (rad), positive to the right
+    3. confidence: fraction of the sampled points on the line
+    """
+
+    def __init__(self, max_rows=3, stride=8, hypotheses=64, tolerance=0.04, min_inliers=0.1, max_slope=1.0, max_points=2000, seed=0):
+        self.MAX_ROWS = max_rows
+        self.STRIDE = stride
+        self.HYPOTHESES = hypotheses
+        self.TOLERANCE = tolerance # fraction of the image width
+        self.MIN_INLIERS = min_inliers
+        self.MAX_SLOPE = max_slope
+        self.MAX_POINTS = max_points
+        self.rng = np.random.RandomState(seed)
+
+    ## Sample Points
+    """
+    Returns the (y, x) coordinates of the sampled plant pixels, thinned to at most MAX_POINTS
+    """
+    def sample(self, mask):
+        (ys, xs) = np.nonzero(mask[::self.STRIDE, ::self.STRIDE])
+        step = len(ys) // self.MAX_POINTS + 1
+        return (ys[::step] * float(self.STRIDE), xs[::step] * float(self.STRIDE))
+
+    ## Best Line
+    """
+    1. Slope and intercept of the line through each random pair of points
+    2. Pairs on the same row, or leaning more than MAX_SLOPE, are discarded
+    3. Returns the inlier flags of the hypothesis with the most inliers
+    """
+    def best_line(self, ys, xs, tolerance):
+        (i, j) = self.rng.randint(0, len(ys), (2, self.HYPOTHESES))
+        dy = ys[j] - ys[i]
+        valid = dy != 0
+        (i, j, dy) = (i[valid], j[valid], dy[valid])
+        slope = (xs[j] - xs[i]) / dy
+        valid = np.abs(slope) <= self.MAX_SLOPE
+        (i, slope) = (i[valid], slope[valid])
+        if len(slope) == 0:
+            return None
+        intercept = xs[i] - slope * ys[i]
+        residuals = np.abs(xs - slope[:, None] * ys - intercept[:, None])
+        inliers = residuals < tolerance
+        return inliers[inliers.sum(axis=1).argmax()]
+
+    ## Fit Lines
+    """
+    1. Repeats the RANSAC search for up to MAX_ROWS lines
+    2. Stops when the best line holds less than MIN_INLIERS of the sample
+    """
+    def fit(self, mask):
+        (h, w) = mask.shape
+        (ys, xs) = self.sample(mask)
+        total = len(ys)
+        tolerance = self.TOLERANCE * w
+        lines = []
+        while len(lines) < self.MAX_ROWS and len(ys) >= max(2, self.MIN_INLIERS * total):
+            inliers = self.best_line(ys, xs, tolerance)
+            if inliers is None or inliers.sum() < max(2, self.MIN_INLIERS * total):
+                break
+            (slope, intercept) = np.polyfit(ys[inliers], xs[inliers], 1)
+            inliers = np.abs(xs - slope * ys - intercept) < tolerance
+            offset = slope * h + intercept - w / 2.0
+            lines.append((offset, np.arctan(-slope), inliers.sum() / float(total)))
+            (ys, xs) = (ys[~inliers], xs[~inliers])
+        lines.sort(key=lambda line: abs(line[0]))
+        return lines
+
+class GroundPlane:
+    """
+    Inverse-perspective (bird's-eye) remap of a camera image onto the ground
+    1. Pinhole camera at a height (cm) above flat ground, tilted forward from vertical (rad)
+    2. The output has the size of the input and one scale (px/cm) everywhere,
+       equal to the image scale on the optical axis
+    3. The maps are built once per geometry and resolution, converted to the
+       fixed-point (CV_16SC2) format and cached on disk
+    """
+
+    def __init__(self, width=640, height=480, camera_height=1.0, fov=0.7, tilt=0.0, cache_dir='cache'):
+        self.SIZE = (width, height)
+        self.CAMERA_HEIGHT = camera_height
+        self.CAMERA_FOV = fov
+        self.CAMERA_TILT = tilt
+        self.CACHE_DIR = cache_dir
+        self.FOCAL = (width / 2.0) / np.tan(fov / 2.0) # px
+        self.PIXEL_PER_CM = self.FOCAL * np.cos(tilt) / camera_height
+        self.GROUND_WIDTH = width / self.PIXEL_PER_CM
+        (self.map1, self.map2) = self.load()
+
+    ## Load or Build
+    """
+    1. Load the fixed-point maps of this geometry from the cache directory
+    2. Otherwise build them and try to save them for the next start-up
+    """
+    def load(self):
+        name = 'ground_%dx%d_h%g_f%g_t%g.npz' % (self.SIZE + (self.CAMERA_HEIGHT, self.CAMERA_FOV, self.CAMERA_TILT))
+        path = os.path.join(self.CACHE_DIR, name)
+        try:
+            cached = np.load(path)
+            return (cached['map1'], cached['map2'])
+        except (IOError, ValueError, KeyError):
+            pass
+        (map_x, map_y) = self.build_maps()
+        (map1, map2) = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        try:
+            if not os.path.isdir(self.CACHE_DIR):
+                os.makedirs(self.CACHE_DIR)
+            np.savez(path, map1=map1, map2=map2)
+        except (IOError, OSError) as error:
+            print('\tERROR in GroundPlane.load(): %s' % str(error))
+        return (map1, map2)
+
+    ## Build Maps
+    """
+    1. Ground point (cm) of every output pixel: lateral from the centre column,
+       forward from the point on the optical axis, up the image
+    2. Rotate into the camera frame and project through the pinhole
+    3. Points behind the camera or outside the image map to the border
+    """
+    def build_maps(self):
+        (w, h) = self.SIZE
+        (u, v) = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(h, dtype=np.float64))
+        x = (u - w / 2.0) / self.PIXEL_PER_CM
+        y = self.CAMERA_HEIGHT * np.tan(self.CAMERA_TILT) + (h / 2.0 - v) / self.PIXEL_PER_CM
+        (sin, cos) = (np.sin(self.CAMERA_TILT), np.cos(self.CAMERA_TILT))
+        depth = y * sin + self.CAMERA_HEIGHT * cos
+        down = self.CAMERA_HEIGHT * sin - y * cos
+        visible = depth > 0
+        depth[~visible] = 1.0
+        map_x = w / 2.0 + self.FOCAL * x / depth
+        map_y = h / 2.0 + self.FOCAL * down / depth
+        outside = ~visible | (map_x < 0) | (map_x > w - 1) | (map_y < 0) | (map_y > h - 1)
+        map_x[outside] = -1
+        map_y[outside] = -1
+        return (map_x.astype(np.float32), map_y.astype(np.float32))
+
+    ## Remap
+    """
+    One fixed-point remap of a mask (or image) onto the ground plane
+    Masks are binary, so nearest-neighbour is the default; it skips the
+    interpolation table (map2) and is several times faster than linear
+    """
+    def remap(self, img, dst=None, interpolation=cv2.INTER_NEAREST):
+        map2 = None if interpolation == cv2.INTER_NEAREST else self.map2
+        return cv2.remap(img, self.map1, map2, interpolation, dst=dst, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+class CameraFusion:
+    """
+    Confidence-weighted fusion of the newest measurement of each camera
+    1. update() keeps the newest (offset, timestamp, confidence, heading) of a camera,
+       so a camera processed at a reduced rate still contributes between its frames
+    2. fuse() drops cameras whose measurement is older than MAX_AGE (s) or less
+       confident than MIN_CONFIDENCE, and weights the rest by their confidence
+    Confidence is the peak-to-mean ratio of the column profile, or the inlier
+    fraction of the fitted line in the 'lines' offset mode
+    """
+
+    def __init__(self, max_age=0.5, min_confidence=1.5, lookahead=0.0):
+        self.MAX_AGE = max_age
+        self.MIN_CONFIDENCE = min_confidence
+        self.LOOKAHEAD = lookahead # rows ahead of the bottom of the image
+        self.measurements = {}
+        self.used = {}
+        self.stale = {}
+        self.rejected = {}
+
+    def update(self, cam_num, offset, timestamp, confidence=None, heading=None):
+        if offset is not None:
+            self.measurements[cam_num] = (offset, timestamp, confidence, heading)
+
+    ## Fuse
+    """
+    1. Drop stale and low-confidence cameras
+    2. Project each offset to the lookahead row along its heading
+    3. Returns the confidence-weighted (offset, heading), or (None, None) if every camera was dropped
+    A camera without a confidence is given a weight of one
+    """
+    def fuse(self, now):
+        (total, offset, heading_total, heading) = (0.0, 0.0, 0.0, 0.0)
+        for (cam_num, (o, t, confidence, angle)) in self.measurements.items():
+            if now - t > self.MAX_AGE:
+                self.stale[cam_num] = self.stale.get(cam_num, 0) + 1
+                continue
+            if confidence is not None and confidence < self.MIN_CONFIDENCE:
+                self.rejected[cam_num] = self.rejected.get(cam_num, 0) + 1
+                continue
+            self.used[cam_num] = self.used.get(cam_num, 0) + 1
+            weight = 1.0 if confidence is None else confidence
+            if angle is not None:
+                o += self.LOOKAHEAD * np.tan(angle)
+                heading += weight * angle
+                heading_total += weight
+            offset += weight * o
+            total += weight
+        if total == 0:
+            return (None, None)
+        return (offset / total, heading / heading_total if heading_total else None)
+
+    def get_stats(self):
+        cams = sorted(set(self.used) | set(self.stale) | set(self.rejected))
+        return dict((c, {'used' : self.used.get(c, 0), 'stale' : self.stale.get(c, 0), 'rejected' : self.rejected.get(c, 0)}) for c in cams)
 
 class RowFinder:
 
-    def __init__(self, cams=1, verbose=True, width=640, height=480, depth=1.0, fov=0.7, date_format="%Y-%m-%d %H:%M:%S"):
+    def __init__(self, cams=1, verbose=True, width=640, height=480, depth=1.0, fov=0.7, tilt=0.0, ground_remap=False, date_format="%Y-%m-%d %H:%M:%S", threaded=False,
+                 hue_min=20, hue_max=60, sat_min=0, sat_max=255, val_min=0, val_max=255,
+                 filter_mode='hsv', lut_bits=5, cache_dir='cache', threshold_percentile=95,
+                 offset_mode='full', roi_band=(0.5, 1.0), roi_window=0.125, roi_confidence=1.5,
+                 record_dir=None, record_frames=600, line_rows=3, line_tolerance=0.04, line_lookahead=0.5,
+                 pyramid_scale=4, pyramid_window=0.125, fusion_max_age=0.5, fusion_min_confidence=None,
+                 camera_sources=None, source_pace='realtime', source_loop=False, source_prefetch=8, source_fps=None,
+                 quality_min_peak=2.0, quality_min_coverage=0.01, quality_max_band=0.25,
+                 adaptive_refresh=0, adaptive_stride=4, adaptive_alpha=0.3, adaptive_jump=25.0, stripes=1,
+                 correlation_alpha=0.2, correlation_max_shift=0.25, correlation_min=0.5,
+                 periodic_min_spacing=0.2, periodic_max_spacing=0.8, periodic_min_strength=0.2):
         self.DATE_FORMAT = date_format
         self.VERBOSE = verbose
         self.NUM_CAMERAS = cams
@@ -19,59 +919,288 @@ class RowFinder:
         self.CAMERA_CENTER = self.CAMERA_WIDTH / 2
         self.GROUND_WIDTH = 2 * self.CAMERA_DEPTH * np.tan(self.CAMERA_FOV / 2.0)
         self.PIXEL_PER_CM = self.CAMERA_WIDTH / self.GROUND_WIDTH
+        self.CAMERA_TILT = tilt
+        self.ground_plane = None
+        if ground_remap:
+            self.ground_plane = GroundPlane(width, height, depth, fov, tilt, cache_dir)
+            self.GROUND_WIDTH = self.ground_plane.GROUND_WIDTH
+            self.PIXEL_PER_CM = self.ground_plane.PIXEL_PER_CM
+        self.HUE_MIN = hue_min
+        self.HUE_MAX = hue_max
+        self.SAT_MIN = sat_min
+        self.SAT_MAX = sat_max
+        self.VAL_MIN = val_min
+        self.VAL_MAX = val_max
+        self.FILTER_MODE = filter_mode
+        self.colour_table = None
+        if self.FILTER_MODE == 'lut':
+            self.colour_table = ColourTable(lut_bits, cache_dir)
+        self.vegetation_index = None
+        if self.FILTER_MODE in VEGETATION_INDICES:
+            self.vegetation_index = VegetationIndex(self.FILTER_MODE)
+        self.ADAPTIVE_REFRESH = adaptive_refresh # frames, 0 for the full-frame means of every frame
+        self.ADAPTIVE_STRIDE = adaptive_stride
+        self.ADAPTIVE_ALPHA = adaptive_alpha
+        self.ADAPTIVE_JUMP = adaptive_jump
+        self.adaptive = {}
+        self.THRESHOLD_PERCENTILE = threshold_percentile
+        self.OFFSET_MODE = offset_mode
+        self.ROI_BAND = roi_band
+        self.ROI_WINDOW = roi_window
+        self.ROI_CONFIDENCE = roi_confidence
+        self.rois = {}
+        self.PYRAMID_SCALE = pyramid_scale
+        self.CORRELATION_ALPHA = correlation_alpha
+        self.CORRELATION_MAX_SHIFT = correlation_max_shift
+        self.CORRELATION_MIN = correlation_min
+        self.correlators = {}
+        self.PERIODIC_MIN_SPACING = periodic_min_spacing
+        self.PERIODIC_MAX_SPACING = periodic_max_spacing
+        self.PERIODIC_MIN_STRENGTH = periodic_min_strength
+        self.periodics = {}
+        self.PYRAMID_WINDOW = pyramid_window
+        self.LINE_LOOKAHEAD = line_lookahead * self.CAMERA_HEIGHT # rows ahead of the bottom of the image
+        self.line_fitter = LineFitter(line_rows, tolerance=line_tolerance)
+        self.lines = {}
+        self.headings = {}
+        self.confidences = {}
+        self.qualities = {}
+        self.fused_heading = None # heading fused with the last estimate_row() offset
+        self.QUALITY_MIN_PEAK = quality_min_peak
+        self.QUALITY_MIN_COVERAGE = quality_min_coverage
+        self.QUALITY_MAX_BAND = quality_max_band
+        if fusion_min_confidence is None:
+            fusion_min_confidence = 0.1 if self.OFFSET_MODE == 'lines' else 1.5 # inlier fraction, or peak-to-mean ratio
+        self.fusion = CameraFusion(fusion_max_age, fusion_min_confidence, self.LINE_LOOKAHEAD)
+        self.buffers = dict((i, FrameBuffers(self.CAMERA_WIDTH, self.CAMERA_HEIGHT)) for i in range(self.NUM_CAMERAS))
+        self.stripe_pool = StripePool(stripes)
         if self.VERBOSE:
             print('[Initialing Cameras] %s' % datetime.strftime(datetime.now(), self.DATE_FORMAT))
             print('\tImage Width: %d px' % self.CAMERA_WIDTH)
             print('\tImage Height: %d px' % self.CAMERA_HEIGHT)
             print('\tCamera Height: %d cm' % self.CAMERA_DEPTH)
             print('\tCamera FOV: %f rad' % self.CAMERA_FOV)
+            print('\tCamera Tilt: %f rad' % self.CAMERA_TILT)
             print('\tImage Center: %d px' % self.CAMERA_CENTER)
             print('\tGround Width: %d cm' % self.GROUND_WIDTH)
             print('\tPixel-per-cm: %d px/cm' % self.PIXEL_PER_CM)
         self.cameras = []
         for i in range(self.NUM_CAMERAS):
+            source = camera_sources[i] if camera_sources else i
+            if not sources.is_device(source):
+                if self.VERBOSE: print('\tInitializing Camera: %d (%s, %s)' % (i, source, source_pace))
+                cam = sources.open_source(source, self.CAMERA_WIDTH, self.CAMERA_HEIGHT, source_pace, source_loop, source_prefetch, source_fps)
+                self.cameras.append(cam)
+                continue
             if self.VERBOSE: print('\tInitializing Camera: %d' % i)
-            cam = cv2.VideoCapture(i)
+            cam = cv2.VideoCapture(int(source))
             print cam
             print i, cv.CV_CAP_PROP_FRAME_WIDTH, cv.CV_CAP_PROP_FRAME_HEIGHT
             cam.set(cv.CV_CAP_PROP_FRAME_WIDTH, self.CAMERA_WIDTH)
             cam.set(cv.CV_CAP_PROP_FRAME_HEIGHT, self.CAMERA_HEIGHT)
             self.cameras.append(cam)
+        self.recorders = [None] * self.NUM_CAMERAS
+        if record_dir:
+            session = datetime.strftime(datetime.now(), '%Y%m%d_%H%M%S')
+            for i in range(self.NUM_CAMERAS):
+                path = os.path.join(record_dir, '%s_cam%d.rec' % (session, i))
+                if self.VERBOSE: print('\tRecording Camera %d: %s' % (i, path))
+                self.recorders[i] = recorder.FrameRecorder(path, self.CAMERA_WIDTH, self.CAMERA_HEIGHT, 3, record_frames)
+        self.THREADED = threaded
+        self.sequences = [0] * self.NUM_CAMERAS
+        self.grabbers = {}
+        if self.THREADED:
+            for (i, cam) in enumerate(self.cameras):
+                if self.is_fast_source(cam):
+                    continue # read in order by capture_frame, so that no frame is dropped
+                grabber = FrameGrabber(cam, i, self.recorders[i])
+                grabber.start()
+                self.grabbers[i] = grabber
         
-    ## Capture Images
+    ## Capture Frame
     """
-    1. Attempt to capture an image
-    2. Repeat for each capture interface
+    1. If threaded, take the newest frame from the grabber without blocking
+       (file sources in 'fast' pace have no grabber, and are read in order)
+    2. Otherwise, attempt to capture an image from the interface
+    3. Returns (bgr, timestamp, sequence)
     """
-    def capture_image(self, cam_num):
+    def capture_frame(self, cam_num):
         if self.VERBOSE: print('[Capturing Images] %s' % datetime.strftime(datetime.now(), self.DATE_FORMAT))
         try:
+            if cam_num in self.grabbers:
+                return self.grabbers[cam_num].latest()
             cam = self.cameras[cam_num]
             (s, bgr) = cam.read() 
             if s:
-                return bgr
+                self.sequences[cam_num] += 1
+                t = time.time()
+                if self.recorders[cam_num] is not None:
+                    self.recorders[cam_num].write(bgr, t, self.sequences[cam_num])
+                return (bgr, t, self.sequences[cam_num])
         except Exception as error:
             print str(error)
+        return (None, None, None)
+
+    ## Capture Images
+    """
+    1. Attempt to capture an image
+    2. Repeat for each capture interface
+    """
+    def capture_image(self, cam_num):
+        (bgr, timestamp, sequence) = self.capture_frame(cam_num)
+        return bgr
+
+    ## Capture Statistics
+    """
+    Returns the grabbed/dropped/repeated/failed frame counters of each camera with a grabber
+    """
+    def get_capture_stats(self):
+        return dict((i, g.get_stats()) for (i, g) in self.grabbers.items())
+
+    ## Sources Finished
+    """
+    True once every camera is a file source that has delivered its last frame,
+    and its grabber, if any, has handed that frame out
+    """
+    def sources_finished(self):
+        if not self.cameras or not all(isinstance(c, sources.FileSource) and c.finished() for c in self.cameras):
+            return False
+        return all(g.sequence == g.consumed for g in self.grabbers.values())
+
+    ## Free Running
+    """
+    True if every camera is a file source in 'fast' pace, so the loop should
+    take every frame as soon as it is decoded rather than pace itself
+    """
+    def free_running(self):
+        return bool(self.cameras) and all(self.is_fast_source(c) for c in self.cameras)
+
+    def is_fast_source(self, camera):
+        return isinstance(camera, sources.FileSource) and camera.PACE == 'fast'
 
     ## Green Filter
     """
     1. RBG --> HSV
     2. Set minimum saturation equal to the mean saturation
     3. Set minimum value equal to the mean value
+       (running estimates if ADAPTIVE_REFRESH is set, see AdaptiveThreshold)
     4. Take hues within range from green-yellow to green-blue
+    Thresholds default to those given at initialization
+    The lut and vegetation index (exg, exgr, cive) modes return the same mask type
+    The mask is a work buffer of the camera, overwritten by its next frame
+    The hsv and lut modes run stripe by stripe on the StripePool, if it has more than one
     """
-    def plant_filter(self, bgr, hue_min=20, hue_max=60, sat_max=255, val_max=0):
+    def plant_filter(self, bgr, hue_min=None, hue_max=None, sat_max=None, val_max=None, cam_num=0):
         if self.VERBOSE: print('[Filtering for Plants] %s' % datetime.strftime(datetime.now(), self.DATE_FORMAT))
         try:
-            hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
-            sat_min = hsv[:,:,1].mean() # cutoff for how saturated the color must be
-            val_min = hsv[:,:,2].mean()
-            threshold_min = np.array([hue_min, sat_min, val_min], np.uint8)
-            threshold_max = np.array([hue_max, sat_max, val_max], np.uint8)
-            mask = cv2.inRange(hsv, threshold_min, threshold_max)
+            if hue_min is None: hue_min = self.HUE_MIN
+            if hue_max is None: hue_max = self.HUE_MAX
+            if sat_max is None: sat_max = self.SAT_MAX
+            if val_max is None: val_max = self.VAL_MAX
+            buffers = self.get_buffers(cam_num)
+            if self.FILTER_MODE == 'lut':
+                return self.lut_filter(bgr, hue_min, hue_max, sat_max, val_max, buffers, self.get_adaptive(cam_num))
+            if self.vegetation_index is not None:
+                return self.vegetation_index.segment(bgr, buffers)
+            (h, w) = bgr.shape[:2]
+            hsv = buffers.get('hsv', (h, w, 3))
+            adaptive = self.get_adaptive(cam_num)
+            sums = self.stripe_pool.run(lambda i, top, bottom: self.hsv_stripe(bgr, hsv, top, bottom, adaptive is None), h, w)
+            if sums is None:
+                hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV, dst=hsv)
+            if adaptive is not None:
+                (sat_mean, val_mean) = adaptive.update(sample_sat_val, hsv)
+            elif sums is None:
+                (hue_mean, sat_mean, val_mean, _) = cv2.mean(hsv)
+            else:
+                (sat_mean, val_mean) = np.sum(sums, axis=0) / float(h)
+            sat_min = max(self.SAT_MIN, sat_mean) # cutoff for how saturated the color must be
+            val_min = max(self.VAL_MIN, val_mean)
+            threshold_min = buffers.get('threshold_min', (3,))
+            threshold_max = buffers.get('threshold_max', (3,))
+            threshold_min[:] = (hue_min, sat_min, val_min)
+            threshold_max[:] = (hue_max, sat_max, val_max)
+            mask = buffers.get('mask', (h, w))
+            if self.stripe_pool.run(lambda i, top, bottom: cv2.inRange(hsv[top:bottom], threshold_min, threshold_max, dst=mask[top:bottom]), h, w) is None:
+                mask = cv2.inRange(hsv, threshold_min, threshold_max, dst=mask)
             return mask
         except Exception as error:
             print('\tERROR in plant_filter(): %s' % str(error))        
+
+    ## HSV Stripe
+    """
+    Converts one stripe to HSV, and returns its saturation and value sums per row if asked
+    """
+    def hsv_stripe(self, bgr, hsv, top, bottom, mean=True):
+        cv2.cvtColor(bgr[top:bottom], cv2.COLOR_BGR2HSV, dst=hsv[top:bottom])
+        if mean:
+            (hue_mean, sat_mean, val_mean, _) = cv2.mean(hsv[top:bottom])
+            return ((bottom - top) * sat_mean, (bottom - top) * val_mean)
+
+    ## Lookup Table Filter
+    """
+    1. Pack BGR pixels into quantised colour indices
+    2. Estimate the mean saturation and value from a subsample of the indices
+       (or take the running estimates, if adaptive)
+    3. Look up the mask in the table compiled for these thresholds
+    """
+    def lut_filter(self, bgr, hue_min, hue_max, sat_max, val_max, buffers=None, adaptive=None):
+        (h, w) = bgr.shape[:2]
+        table = self.colour_table
+        index = None
+        if buffers is not None:
+            (index, bgra) = (buffers.get('index', (h, w), table.INDEX_TYPE), buffers.get('bgra', (h, w, 4)))
+            if self.stripe_pool.run(lambda i, top, bottom: table.pack_into(bgr[top:bottom], index[top:bottom], bgra[top:bottom]), h, w) is None:
+                index = None
+        if index is None:
+            index = table.pack(bgr, buffers)
+        if adaptive is not None:
+            (sat_mean, val_mean) = adaptive.update(lambda index, stride: table.mean_sat_val(index, stride, buffers), index)
+        else:
+            (sat_mean, val_mean) = table.mean_sat_val(index, buffers=buffers)
+        sat_min = max(self.SAT_MIN, sat_mean)
+        val_min = max(self.VAL_MIN, val_mean)
+        lookup = table.compile(hue_min, hue_max, sat_min, sat_max, val_min, val_max)
+        if buffers is None:
+            return table.apply(index, lookup)
+        out = buffers.get('mask', index.shape)
+        if self.stripe_pool.run(lambda i, top, bottom: table.apply(index[top:bottom], lookup, out[top:bottom]), h, w) is None:
+            table.apply(index, lookup, out)
+        return out
+
+    ## Adaptive Threshold
+    """
+    Returns the AdaptiveThreshold of the camera, creating it on first use,
+    or None if ADAPTIVE_REFRESH is not set
+    """
+    def get_adaptive(self, cam_num):
+        if not self.ADAPTIVE_REFRESH:
+            return None
+        adaptive = self.adaptive.get(cam_num)
+        if adaptive is None:
+            adaptive = self.adaptive[cam_num] = AdaptiveThreshold(self.ADAPTIVE_STRIDE, alpha=self.ADAPTIVE_ALPHA,
+                                                                  refresh=self.ADAPTIVE_REFRESH, jump=self.ADAPTIVE_JUMP)
+        return adaptive
+
+    def get_adaptive_stats(self):
+        return [self.adaptive[c].get_stats() for c in sorted(self.adaptive)]
+
+    ## Work Buffers
+    """
+    Returns the FrameBuffers of the camera, creating them on first use
+    """
+    def get_buffers(self, cam_num):
+        buffers = self.buffers.get(cam_num)
+        if buffers is None:
+            buffers = self.buffers[cam_num] = FrameBuffers(self.CAMERA_WIDTH, self.CAMERA_HEIGHT)
+        return buffers
+
+    ## Allocation Statistics
+    """
+    Returns the number of work buffers, allocations and bytes of each camera
+    """
+    def get_allocation_stats(self):
+        return [self.buffers[c].get_stats() for c in sorted(self.buffers)]
         
     ## Find Offset
     """
@@ -80,30 +1209,374 @@ class RowFinder:
     3. Finds indicies which are greater than or equal to the threshold
     4. Finds the median of this array of indices
     5. Repeat for each mask
+    If the ground remap is enabled, the mask is first remapped onto the ground plane
+    The confidence of the offset is kept for the camera, see CameraFusion,
+    and so is the quality of the frame, see frame_quality
     """
-    def find_offset(self, mask, threshold_percentile=0.95):
+    def find_offset(self, mask, threshold_percentile=None, cam_num=0):
         if self.VERBOSE: print('[Finding Offsets] %s' % datetime.strftime(datetime.now(), self.DATE_FORMAT))
+        self.confidences[cam_num] = 0.0
+        self.qualities[cam_num] = None
         try:
-            if mask:
+            if mask is not None:
+                if threshold_percentile is None: threshold_percentile = self.THRESHOLD_PERCENTILE
+                if self.ground_plane is not None:
+                    mask = self.ground_plane.remap(mask, self.get_buffers(cam_num).get('ground', self.ground_plane.map2.shape))
+                if self.OFFSET_MODE == 'roi':
+                    return self.roi_offset(mask, threshold_percentile, cam_num)
+                if self.OFFSET_MODE == 'lines':
+                    return self.line_offset(mask, cam_num)
+                if self.OFFSET_MODE == 'pyramid':
+                    return self.pyramid_offset(mask, threshold_percentile, cam_num)
+                if self.OFFSET_MODE == 'correlate':
+                    return self.correlate_offset(mask, threshold_percentile, cam_num)
+                if self.OFFSET_MODE == 'periodic':
+                    return self.periodic_offset(mask, threshold_percentile, cam_num)
                 (h, w) = mask.shape
-                column_sum = mask.sum(axis=0) # vertical summation
-                threshold = np.percentile(column_sum, threshold_percentile)
-                probable = np.nonzero(column_sum >= threshold) # returns 1 length tuple
-                num_probable = len(probable[0])
-                centroid = int(np.median(probable[0])) - w / 2.0
+                buffers = self.get_buffers(cam_num)
+                column_sum = self.column_sum(mask, buffers) # vertical summation
+                (index, num_probable, confidence) = self.locate_peak(column_sum, threshold_percentile, buffers)
+                self.confidences[cam_num] = confidence
+                self.qualities[cam_num] = self.frame_quality(column_sum, num_probable, confidence, h)
+                centroid = index - w / 2.0
                 return centroid
         except Exception as error:
             print('\tERROR in find_indices(): %s' % str(error))
-        
+
+    ## Column Sum
+    """
+    Vertical summation of a mask (or a view of one) into the camera's buffer
+    If striped, each stripe is summed into a row of partial sums, which are then reduced
+    """
+    def column_sum(self, mask, buffers):
+        (h, w) = mask.shape
+        out = buffers.get('column_sum', (1, self.CAMERA_WIDTH), np.int32)
+        if out.shape[1] < w:
+            out = buffers.get('column_sum', (1, w), np.int32)
+        if self.stripe_pool.STRIPES > 1:
+            partial = buffers.get('stripe_sums', (self.stripe_pool.STRIPES, max(w, self.CAMERA_WIDTH)), np.int32)
+            if self.stripe_pool.run(lambda i, top, bottom: np.sum(mask[top:bottom], axis=0, dtype=np.int32, out=partial[i,:w]), h, w) is not None:
+                return np.sum(partial[:,:w], axis=0, dtype=np.int32, out=out[0,:w])
+        return np.sum(mask, axis=0, dtype=np.int32, out=out[0,:w])
+
+    ## Locate Peak
+    """
+    1. Finds indices of the column sum which are at or above the percentile threshold
+    2. Returns their median, their number and the peak-to-mean ratio of the profile
+    """
+    def locate_peak(self, column_sum, threshold_percentile, buffers=None):
+        scratch = None
+        if buffers is not None:
+            scratch = buffers.get('profile', (max(self.CAMERA_WIDTH, column_sum.size),), np.int32)[:column_sum.size]
+        threshold = partition_percentile(column_sum, threshold_percentile, out=scratch)
+        probable = np.nonzero(column_sum >= threshold) # returns 1 length tuple
+        num_probable = len(probable[0])
+        index = int(np.median(probable[0]))
+        mean = column_sum.mean()
+        confidence = column_sum.max() / mean if mean > 0 else 0.0
+        return (index, num_probable, confidence)
+
+    ## Frame Quality
+    """
+    Cheap evidence of a row in the profile that the offset was found from
+    1. peak_to_mean: peak of the column profile over its mean
+    2. coverage: fraction of the summed pixels that are vegetation
+    3. band_width: fraction of the profile's columns in the probable band
+    rows is the number of mask rows summed into each element of the profile
+    """
+    def frame_quality(self, column_sum, num_probable, confidence, rows):
+        coverage = column_sum.mean() / (255.0 * rows) if rows else 0.0
+        return (confidence, coverage, num_probable / float(column_sum.size))
+
+    ## Quality Gate
+    """
+    True if a frame's (peak_to_mean, coverage, band_width) meets the QUALITY thresholds
+    """
+    def check_quality(self, quality):
+        if quality is None:
+            return False
+        (peak_to_mean, coverage, band_width) = quality
+        return peak_to_mean >= self.QUALITY_MIN_PEAK and coverage >= self.QUALITY_MIN_COVERAGE and band_width <= self.QUALITY_MAX_BAND
+
+    ## Batch Green Filter
+    """
+    Same as plant_filter for a stack of N images (N x H x W x 3)
+    1. One colour conversion (or table packing) over all N images
+    2. Per-image mean saturation and value, and the thresholds broadcast over the stack
+    3. Returns an N x H x W mask array
+    """
+    def plant_filter_batch(self, bgrs, hue_min=None, hue_max=None, sat_max=None, val_max=None):
+        if hue_min is None: hue_min = self.HUE_MIN
+        if hue_max is None: hue_max = self.HUE_MAX
+        if sat_max is None: sat_max = self.SAT_MAX
+        if val_max is None: val_max = self.VAL_MAX
+        (n, h, w) = bgrs.shape[:3]
+        flat = np.ascontiguousarray(bgrs).reshape(n * h, w, 3)
+        if self.FILTER_MODE == 'lut':
+            index = self.colour_table.pack(flat).reshape(n, h, w)
+            sample = index[:, ::4, ::4]
+            sat_min = np.maximum(self.SAT_MIN, np.take(self.colour_table.sat_cube, sample).mean(axis=(1, 2)))
+            val_min = np.maximum(self.VAL_MIN, np.take(self.colour_table.val_cube, sample).mean(axis=(1, 2)))
+            masks = np.empty((n, h, w), np.uint8)
+            for (i, (s, v)) in enumerate(zip(sat_min, val_min)):
+                table = self.colour_table.compile(hue_min, hue_max, s, sat_max, v, val_max) # may reuse an evicted table, so apply it first
+                self.colour_table.apply(index[i], table, masks[i])
+            return masks
+        if self.vegetation_index is not None:
+            index = self.vegetation_index.compute(flat).reshape(n, h * w)
+            offsets = (np.arange(n) * 256)[:, None]
+            hist = np.bincount((index + offsets).ravel(), minlength=n * 256).reshape(n, 256)
+            levels = otsu_level(hist)
+            masks = (index > levels[:, None]).view(np.uint8).reshape(n, h, w)
+            masks *= 255
+            return masks
+        hsv = cv2.cvtColor(flat, cv2.COLOR_BGR2HSV).reshape(n, h, w, 3)
+        (hue, sat, val) = (hsv[...,0], hsv[...,1], hsv[...,2])
+        sat_min = np.maximum(self.SAT_MIN, sat.reshape(n, -1).mean(axis=1)).astype(np.uint8)[:, None, None]
+        val_min = np.maximum(self.VAL_MIN, val.reshape(n, -1).mean(axis=1)).astype(np.uint8)[:, None, None]
+        selected = (hue >= hue_min) & (hue <= hue_max) & (sat >= sat_min) & (sat <= sat_max) & (val >= val_min) & (val <= val_max)
+        masks = selected.view(np.uint8)
+        masks *= 255
+        return masks
+
+    ## Batch Find Offset
+    """
+    Same as find_offset (full frame) for a stack of N masks (N x H x W)
+    1. Column sums of every mask at once
+    2. Per-mask percentile thresholds by partitioning
+    3. Median of the probable columns from their cumulative count, without a per-mask loop
+    4. Returns the N x W column profiles and the N offsets
+    If the ground remap is enabled, the masks are first remapped onto the ground plane
+    """
+    def find_offset_batch(self, masks, threshold_percentile=None):
+        if threshold_percentile is None: threshold_percentile = self.THRESHOLD_PERCENTILE
+        if self.ground_plane is not None:
+            masks = np.array([self.ground_plane.remap(m) for m in masks])
+        (n, h, w) = masks.shape
+        profiles = masks.sum(axis=1)
+        thresholds = partition_percentile(profiles, threshold_percentile, axis=1)
+        probable = profiles >= thresholds[:, None]
+        counts = probable.sum(axis=1)
+        ranks = probable.cumsum(axis=1)
+        lower = (ranks < ((counts + 1) // 2)[:, None]).sum(axis=1)
+        upper = (ranks < (counts // 2 + 1)[:, None]).sum(axis=1)
+        offsets = np.floor((lower + upper) / 2.0) - w / 2.0
+        return (profiles, offsets)
+
+    ## Batch Processing
+    """
+    Returns (masks, profiles, offsets) for a stack of N images
+    Memory grows with N, so long recordings should be passed in chunks
+    """
+    def process_batch(self, bgrs, threshold_percentile=None):
+        masks = self.plant_filter_batch(bgrs)
+        (profiles, offsets) = self.find_offset_batch(masks, threshold_percentile)
+        return (masks, profiles, offsets)
+
+    ## Pyramid Offset
+    """
+    1. Coarse profile: column sum of every PYRAMID_SCALE-th row, binned PYRAMID_SCALE columns at a time
+    2. Coarse peak of the downscaled profile
+    3. Refined peak from the full-resolution column sum of a window around the coarse peak
+    The confidence is that of the coarse peak, over the whole width
+    A low-accuracy fallback for high resolutions, never a default: the coarse profile
+    has few probable bins, and when their median falls between two crop rows the window
+    is refined onto a neighbouring row. In examples/benchmark.py the mean offset error
+    is 72.9 px against 37.9 px for 'full' at 640x480 (58.4 against 88.8 at 1280x720,
+    at half the cost). A coarse level resized with INTER_AREA was no closer (65.6 px)
+    and cost more than the full column sum, so the rows are still decimated
+    """
+    def pyramid_offset(self, mask, threshold_percentile, cam_num):
+        (h, w) = mask.shape
+        buffers = self.get_buffers(cam_num)
+        scale = self.PYRAMID_SCALE
+        column_sum = self.column_sum(mask[::scale, :w // scale * scale], buffers)
+        coarse = column_sum.reshape(-1, scale).sum(axis=1)
+        (index, num_probable, confidence) = self.locate_peak(coarse, threshold_percentile, buffers)
+        self.confidences[cam_num] = confidence
+        self.qualities[cam_num] = self.frame_quality(coarse, num_probable, confidence, (h + scale - 1) // scale * scale)
+        center = index * scale + scale // 2
+        half_width = max(scale, int(self.PYRAMID_WINDOW * w / 2))
+        (left, right) = (max(0, center - half_width), min(w, center + half_width))
+        column_sum = self.column_sum(mask[:, left:right], buffers)
+        (index, num_probable, confidence) = self.locate_peak(column_sum, threshold_percentile, buffers)
+        return left + index - w / 2.0
+
+    ## Region of Interest Offset
+    """
+    1. Sums only the band of rows, within a window around the previous peak
+    2. Accepts the peak if it is confident and not at the edge of the window
+    3. Otherwise falls back to a full-frame search and re-centres the window
+    """
+    def roi_offset(self, mask, threshold_percentile, cam_num):
+        (h, w) = mask.shape
+        buffers = self.get_buffers(cam_num)
+        roi = self.rois.get(cam_num)
+        if roi is None:
+            roi = self.rois[cam_num] = RegionOfInterest(self.ROI_BAND, self.ROI_WINDOW, self.ROI_CONFIDENCE)
+        if roi.center is not None:
+            (left, right) = roi.window(w)
+            column_sum = self.column_sum(mask[roi.top(h):roi.bottom(h), left:right], buffers)
+            (index, num_probable, confidence) = self.locate_peak(column_sum, threshold_percentile, buffers)
+            if confidence >= roi.MIN_CONFIDENCE and roi.MARGIN <= index < (right - left) - roi.MARGIN:
+                roi.hit(left + index, column_sum.size * (roi.bottom(h) - roi.top(h)), h * w)
+                self.confidences[cam_num] = confidence
+                self.qualities[cam_num] = self.frame_quality(column_sum, num_probable, confidence, roi.bottom(h) - roi.top(h))
+                return left + index - w / 2.0
+            roi.miss(column_sum.size * (roi.bottom(h) - roi.top(h)), h * w)
+        column_sum = self.column_sum(mask, buffers)
+        (index, num_probable, confidence) = self.locate_peak(column_sum, threshold_percentile, buffers)
+        roi.reset(index if confidence >= roi.MIN_CONFIDENCE else None, h * w)
+        self.confidences[cam_num] = confidence
+        self.qualities[cam_num] = self.frame_quality(column_sum, num_probable, confidence, h)
+        return index - w / 2.0
+
+    ## Correlation Offset
+    """
+    1. Column sum and percentile peak of the full mask, as the full mode
+    2. The camera's ProfileCorrelator tracks the sub-pixel shift of the profile from its
+       reference, and falls back to the percentile peak when it restarts
+    """
+    def correlate_offset(self, mask, threshold_percentile, cam_num):
+        (h, w) = mask.shape
+        buffers = self.get_buffers(cam_num)
+        column_sum = self.column_sum(mask, buffers)
+        (index, num_probable, confidence) = self.locate_peak(column_sum, threshold_percentile, buffers)
+        self.confidences[cam_num] = confidence
+        self.qualities[cam_num] = self.frame_quality(column_sum, num_probable, confidence, h)
+        correlator = self.correlators.get(cam_num)
+        if correlator is None:
+            correlator = self.correlators[cam_num] = ProfileCorrelator(w, self.CORRELATION_ALPHA, self.CORRELATION_MAX_SHIFT, self.CORRELATION_MIN)
+        return correlator.track(column_sum, index) - w / 2.0
+
+    def get_correlation_stats(self):
+        return [self.correlators[c].get_stats() for c in sorted(self.correlators)]
+
+    ## Periodic Offset
+    """
+    1. Column sum and percentile peak of the full mask, as the full mode
+    2. The camera's PeriodicProfile locks onto the row nearest the centre from the
+       dominant spatial frequency of the profile, or falls back to the percentile peak
+    """
+    def periodic_offset(self, mask, threshold_percentile, cam_num):
+        (h, w) = mask.shape
+        buffers = self.get_buffers(cam_num)
+        column_sum = self.column_sum(mask, buffers)
+        (index, num_probable, confidence) = self.locate_peak(column_sum, threshold_percentile, buffers)
+        self.confidences[cam_num] = confidence
+        self.qualities[cam_num] = self.frame_quality(column_sum, num_probable, confidence, h)
+        periodic = self.periodics.get(cam_num)
+        if periodic is None:
+            periodic = self.periodics[cam_num] = PeriodicProfile(w, self.PERIODIC_MIN_SPACING, self.PERIODIC_MAX_SPACING, self.PERIODIC_MIN_STRENGTH)
+        return periodic.track(column_sum, index) - w / 2.0
+
+    ## Row Spacing
+    """
+    Returns the running row spacing of each camera in the periodic mode, in px and cm (None until found)
+    """
+    def get_spacing_stats(self):
+        stats = []
+        for c in sorted(self.periodics):
+            s = self.periodics[c].get_stats()
+            s['spacing_cm'] = s['spacing'] / self.PIXEL_PER_CM if s['spacing'] is not None else None
+            stats.append(s)
+        return stats
+
+    ## Region of Interest Statistics
+    """
+    Returns the window geometry and hit/miss counters of each camera
+    """
+    def get_roi_stats(self):
+        return [self.rois[c].get_stats() for c in sorted(self.rois)]
+
+    ## Camera Statistics
+    """
+    Returns the per-camera statistics as {kind : {cam_num : stats}}, for the given
+    cameras only if cam_nums is set, e.g. those a VisionWorker was measuring
+    Kinds are allocations, adaptive, roi, correlation and spacing
+    """
+    def get_camera_stats(self, cam_nums=None):
+        stats = {
+            'allocations' : dict((c, b.get_stats()) for (c, b) in self.buffers.items()),
+            'adaptive' : dict((c, a.get_stats()) for (c, a) in self.adaptive.items()),
+            'roi' : dict((c, r.get_stats()) for (c, r) in self.rois.items()),
+            'correlation' : dict((c, p.get_stats()) for (c, p) in self.correlators.items()),
+            'spacing' : dict((c, p.get_stats()) for (c, p) in self.periodics.items())
+        }
+        for s in stats['spacing'].values():
+            s['spacing_cm'] = s['spacing'] / self.PIXEL_PER_CM if s['spacing'] is not None else None
+        if cam_nums is not None:
+            for (kind, cams) in stats.items():
+                stats[kind] = dict((c, s) for (c, s) in cams.items() if c in cam_nums)
+        return stats
+
+    ## Reset Tracking
+    """
+    Forgets what every camera carried over from its previous frames: the ROI,
+    correlation reference, periodic lock, adaptive thresholds, lines, and the
+    last measurements kept for the fusion and their fused heading
+    """
+    def reset_tracking(self):
+        for state in (self.adaptive, self.rois, self.correlators, self.periodics, self.lines, self.headings, self.confidences, self.qualities):
+            state.clear()
+        self.fusion.measurements.clear()
+        self.fused_heading = None
+
+    ## Fit Crop Lines
+    """
+    Returns every crop line found in the mask as (offset, angle, confidence),
+    nearest the centre first, and keeps them for the camera
+    """
+    def fit_lines(self, mask, cam_num=0):
+        lines = self.line_fitter.fit(mask)
+        self.lines[cam_num] = lines
+        return lines
+
+    ## Line Offset
+    """
+    1. Fits the crop lines and takes the one nearest the centre
+    2. Keeps its heading for estimate_row and returns its lateral offset
+    The frame quality is taken from the profile of the rows the fitter samples
+    """
+    def line_offset(self, mask, cam_num):
+        rows = mask[::self.line_fitter.STRIDE]
+        column_sum = self.column_sum(rows, self.get_buffers(cam_num))
+        (index, num_probable, peak_to_mean) = self.locate_peak(column_sum, self.THRESHOLD_PERCENTILE, self.get_buffers(cam_num))
+        self.qualities[cam_num] = self.frame_quality(column_sum, num_probable, peak_to_mean, rows.shape[0])
+        lines = self.fit_lines(mask, cam_num)
+        if not lines:
+            self.headings[cam_num] = None
+            return None
+        (offset, angle, confidence) = lines[0]
+        self.headings[cam_num] = angle
+        self.confidences[cam_num] = confidence
+        return offset
+
     ## Best guess for row based on calculated offsets of multiple cameras
     """
-    1. If outside bounds, default to edges
-    2. If inside, use mean of detected indices from both cameras
+    1. Each camera's offset updates the fusion, with its timestamp, confidence and heading
+       (a camera without an offset keeps its previous measurement)
+    2. Returns the confidence-weighted offset (px, not rounded, so sub-pixel offsets
+       reach the controller) of the fresh and confident cameras, see CameraFusion
+    3. None if every camera was dropped
+    The confidence-weighted heading of the same cameras is kept in fused_heading
+    Offsets without a timestamp are taken as current, and confidences default
+    to those kept by find_offset
     """
-    def estimate_row(self, offsets):
+    def estimate_row(self, offsets, headings=None, timestamps=None, confidences=None):
         if self.VERBOSE: print('[Making Best Guess of Crop Row] %s' % datetime.strftime(datetime.now(), self.DATE_FORMAT))
         try:
-            estimated =  int(np.mean(offsets))
+            now = time.time()
+            for (cam_num, offset) in enumerate(offsets):
+                timestamp = timestamps[cam_num] if timestamps is not None and timestamps[cam_num] is not None else now
+                confidence = confidences[cam_num] if confidences is not None else self.confidences.get(cam_num)
+                heading = headings[cam_num] if headings is not None else None
+                self.fusion.update(cam_num, offset, timestamp, confidence, heading)
+            (offset, heading) = self.fusion.fuse(now)
+            self.fused_heading = heading
+            if offset is None:
+                return None
+            estimated = float(offset)
             return estimated
         except Exception as error:
             print('\tERROR in estimate_row(): %s' % str(error))
@@ -140,5 +1613,11 @@ class RowFinder:
     
     # Close
     def close(self):
+        self.stripe_pool.close()
+        for g in self.grabbers.values():
+            g.stop()
         for c in self.cameras:
             c.release()
+        for r in self.recorders:
+            if r is not None:
+                r.close()
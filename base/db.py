@@ -9,7 +9,9 @@ from datetime import datetime
 
 class Logger:
 
-    def __init__(self, log_format='%Y%m%d.log', mongo_format='%Y%m%d'):
+    def __init__(self, log_format='%Y%m%d.log', mongo_format='%Y%m%d', time_format='%Y-%m-%d %H:%M:%S.%f', verbose=False):
+        self.TIME_FORMAT = time_format
+        self.VERBOSE = verbose
         self.LOG_NAME = datetime.strftime(datetime.now(), log_format)
         self.MONGO_NAME = datetime.strftime(datetime.now(), mongo_format)
         print('Connecting to MongoDB: %s' % self.MONGO_NAME)
@@ -0,0 +1,173 @@
+"""
+preview.py
+Rate-limited debug view, composited and shown off the control thread
+"""
+
+import cv2
+import numpy as np
+import threading
+import time
+
+class Preview(threading.Thread):
+    """
+    Shows one row per camera: the BGR image and its mask, with the detected row drawn on both
+    1. submit() only copies into a pending slot, and drops frames that are not due yet
+       or that arrive while the slot still holds an undrawn frame
+    2. The thread swaps the pending slot with its own, draws into a reusable composite
+       buffer and shows it, at most RATE times per second
+    imshow and waitKey only ever run on this thread
+    """
+
+    def __init__(self, width=640, height=480, cams=1, rate=10.0, window='cv-drive', fullscreen=False):
+        threading.Thread.__init__(self, name='preview')
+        self.daemon = True
+        self.SHAPE = (height, width)
+        self.CAMS = cams
+        self.PERIOD = 1.0 / rate if rate > 0 else 0.0
+        self.WINDOW = window
+        self.FULLSCREEN = fullscreen
+        self.pending = self.allocate()
+        self.drawing = self.allocate()
+        self.composite = np.zeros((height * cams, width * 2, 3), np.uint8)
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.running = True
+        self.has_pending = False
+        self.next_due = 0.0
+        self.submitted = 0
+        self.dropped = 0
+        self.drawn = 0
+
+    ## Allocate Slot
+    """
+    One slot holds a BGR image, a mask and a row line for each camera
+    """
+    def allocate(self):
+        (h, w) = self.SHAPE
+        return {
+            'bgr' : [np.zeros((h, w, 3), np.uint8) for c in range(self.CAMS)],
+            'mask' : [np.zeros((h, w), np.uint8) for c in range(self.CAMS)],
+            'line' : [None] * self.CAMS
+        }
+
+    ## Submit
+    """
+    1. Drop the frame if the preview is not due, or the last one has not been drawn
+    2. Otherwise copy the images, masks and row lines into the pending slot and wake the thread
+    Offsets are from the image centre (px); a heading (rad) tilts the line about the bottom row
+    Returns True if the frame was taken
+    """
+    def submit(self, imgs, masks=None, offsets=None, headings=None):
+        now = time.time()
+        if now < self.next_due or self.has_pending or not self.lock.acquire(False):
+            self.dropped += 1
+            return False
+        try:
+            (h, w) = self.SHAPE
+            for c in range(min(self.CAMS, len(imgs))):
+                self.copy(imgs[c], self.pending['bgr'][c])
+                if masks is not None and masks[c] is not None:
+                    self.copy(masks[c], self.pending['mask'][c])
+                else:
+                    self.pending['mask'][c].fill(0)
+                offset = offsets[c] if offsets is not None else None
+                heading = headings[c] if headings is not None else None
+                if offset is None:
+                    self.pending['line'][c] = None
+                elif heading is None:
+                    x = int(w / 2.0 + offset)
+                    self.pending['line'][c] = ((x, 0), (x, h - 1))
+                else:
+                    x = w / 2.0 + offset
+                    self.pending['line'][c] = ((int(x), h - 1), (int(x + (h - 1) * np.tan(heading)), 0))
+            self.has_pending = True
+            self.next_due = now + self.PERIOD
+            self.submitted += 1
+        finally:
+            self.lock.release()
+        self.ready.set()
+        return True
+
+    def copy(self, src, dst):
+        if src is None:
+            dst.fill(0)
+        elif src.shape == dst.shape:
+            np.copyto(dst, src)
+        else:
+            cv2.resize(src, (dst.shape[1], dst.shape[0]), dst=dst)
+
+    ## Draw
+    """
+    1. BGR on the left and the mask (as grey BGR) on the right, one row per camera
+    2. The row line in white across both
+    """
+    def draw(self, slot):
+        (h, w) = self.SHAPE
+        for c in range(self.CAMS):
+            row = self.composite[c * h:(c + 1) * h]
+            np.copyto(row[:, :w], slot['bgr'][c])
+            np.copyto(row[:, w:], slot['mask'][c][:, :, None])
+            line = slot['line'][c]
+            if line is not None:
+                ((x0, y0), (x1, y1)) = line
+                cv2.line(self.composite, (x0, c * h + y0), (x1, c * h + y1), (255, 255, 255), 1)
+                cv2.line(self.composite, (w + x0, c * h + y0), (w + x1, c * h + y1), (255, 255, 255), 1)
+        return self.composite
+
+    ## Output
+    """
+    Where the composite goes; subclasses (e.g. stream.Stream) override these
+    """
+    def open(self):
+        if self.FULLSCREEN:
+            cv2.namedWindow(self.WINDOW, cv2.WND_PROP_FULLSCREEN)
+            cv2.setWindowProperty(self.WINDOW, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    def show(self, composite):
+        cv2.imshow(self.WINDOW, composite)
+        cv2.waitKey(1)
+
+    def idle(self):
+        cv2.waitKey(1)
+
+    def shut(self):
+        try:
+            cv2.destroyWindow(self.WINDOW)
+        except cv2.error:
+            pass
+
+    ## Preview Loop
+    """
+    1. Wait for a pending frame, then swap it with the drawing slot
+    2. Draw the composite and show it
+    """
+    def run(self):
+        self.open()
+        while self.running:
+            if not self.ready.wait(0.5):
+                self.idle()
+                continue
+            if not self.running:
+                break
+            with self.lock:
+                self.ready.clear()
+                (self.pending, self.drawing) = (self.drawing, self.pending)
+                self.has_pending = False
+            try:
+                self.show(self.draw(self.drawing))
+                self.drawn += 1
+            except Exception as error:
+                print('\tERROR in %s.run(): %s' % (self.__class__.__name__, str(error)))
+        self.shut()
+
+    def get_stats(self):
+        return {
+            'submitted' : self.submitted,
+            'dropped' : self.dropped,
+            'drawn' : self.drawn
+        }
+
+    def stop(self, timeout=1.0):
+        self.running = False
+        self.ready.set()
+        self.join(timeout)
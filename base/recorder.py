@@ -0,0 +1,166 @@
+"""
+recorder.py
+Memory-mapped raw frame recorder with a time index
+
+File layout
+1. Header: magic, width, height, channels, slots, frames written
+2. Index: (timestamp, sequence) of every slot
+3. Frames: raw BGR of every slot, page aligned
+Slots are overwritten in a ring, so the file always holds the newest frames
+"""
+
+import cv2
+import mmap
+import numpy as np
+import os
+import struct
+
+MAGIC = b'CVDREC01'
+HEADER = struct.Struct('<8sIIIIq')
+INDEX_TYPE = np.dtype([('timestamp', '<f8'), ('sequence', '<i8')])
+PAGE = mmap.PAGESIZE
+
+def layout(width, height, channels, slots):
+    index_offset = HEADER.size
+    frames_offset = index_offset + slots * INDEX_TYPE.itemsize
+    frames_offset = (frames_offset + PAGE - 1) // PAGE * PAGE
+    size = frames_offset + slots * width * height * channels
+    return (index_offset, frames_offset, size)
+
+class FrameRecorder:
+    """
+    Appends raw frames to a pre-allocated ring file
+    1. Each write is one copy into the mapped slot, without any encoding
+    2. The index entry and the frame counter in the header follow the copy
+    """
+
+    def __init__(self, path, width=640, height=480, channels=3, slots=600):
+        self.path = path
+        self.SHAPE = (height, width, channels)
+        self.SLOTS = slots
+        (index_offset, frames_offset, size) = layout(width, height, channels, slots)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.buffer = mmap.mmap(self.file.fileno(), size)
+        self.index = np.frombuffer(self.buffer, INDEX_TYPE, slots, index_offset)
+        self.frames = np.frombuffer(self.buffer, np.uint8, slots * width * height * channels, frames_offset).reshape((slots,) + self.SHAPE)
+        self.count = 0
+        HEADER.pack_into(self.buffer, 0, MAGIC, width, height, channels, slots, 0)
+
+    ## Write Frame
+    """
+    1. Copy the frame into the next slot, resizing if the camera ignored the requested size
+    2. Record its timestamp and sequence, then publish the new frame count
+    """
+    def write(self, bgr, timestamp, sequence):
+        slot = self.count % self.SLOTS
+        if bgr.shape == self.SHAPE:
+            np.copyto(self.frames[slot], bgr)
+        else:
+            cv2.resize(bgr, (self.SHAPE[1], self.SHAPE[0]), dst=self.frames[slot])
+        self.index[slot] = (timestamp, sequence)
+        self.count += 1
+        struct.pack_into('<q', self.buffer, HEADER.size - 8, self.count)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.index = None
+        self.frames = None
+        self.buffer.flush()
+        self.buffer.close()
+        self.file.close()
+
+class Recording:
+    """
+    Read-only view of a FrameRecorder file
+    1. Frames are addressed in time order, oldest first
+    2. seek() finds a time by bisection over the ring, O(log n)
+    3. Frames are returned as views into the mapping, without copying
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, width, height, channels, slots, count) = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame recording' % path)
+        (index_offset, frames_offset, size) = layout(width, height, channels, slots)
+        self.SHAPE = (height, width, channels)
+        self.SLOTS = slots
+        self.index = np.frombuffer(self.buffer, INDEX_TYPE, slots, index_offset)
+        self.frames = np.frombuffer(self.buffer, np.uint8, slots * width * height * channels, frames_offset).reshape((slots,) + self.SHAPE)
+        self.length = min(count, slots)
+        self.oldest = count % slots if count > slots else 0
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def slot(self, i):
+        return (self.oldest + i) % self.SLOTS
+
+    def timestamp(self, i):
+        return self.index['timestamp'][self.slot(i)]
+
+    ## Read Frame
+    """
+    Returns (bgr, timestamp, sequence) of the i-th oldest frame
+    """
+    def read(self, i):
+        s = self.slot(i)
+        return (self.frames[s], self.index['timestamp'][s], self.index['sequence'][s])
+
+    ## Seek
+    """
+    1. Bisects for the first frame at or after time t
+    2. Sets the replay position to it and returns its position
+    """
+    def seek(self, t):
+        (lo, hi) = (0, self.length)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.position = lo
+        return lo
+
+    ## Replay
+    """
+    Yields (bgr, timestamp, sequence) from the current position up to time stop
+    """
+    def replay(self, stop=None):
+        while self.position < self.length:
+            frame = self.read(self.position)
+            if stop is not None and frame[1] > stop:
+                break
+            self.position += 1
+            yield frame
+
+    ## Chunks
+    """
+    Yields N x H x W x 3 stacks of consecutive frames for RowFinder.process_batch
+    Stacks never cross the end of the ring, so each one is a view, not a copy
+    """
+    def chunks(self, start=None, stop=None, size=64):
+        first = 0 if start is None else self.seek(start)
+        last = self.length if stop is None else self.seek(stop)
+        i = first
+        while i < last:
+            s = self.slot(i)
+            n = min(size, last - i, self.SLOTS - s)
+            yield (self.frames[s:s + n], self.index[s:s + n])
+            i += n
+
+    def close(self):
+        self.index = None
+        self.frames = None
+        self.buffer.close()
+        self.file.close()
@@ -0,0 +1,243 @@
+"""
+sources.py
+File-backed frame sources, read like a cv2.VideoCapture so the pipeline can run without cameras
+
+A camera is given as a device index, or as a path to
+1. A directory of images, read in name order
+2. A FrameRecorder file (.rec), paced by its recorded timestamps
+3. Anything else cv2.VideoCapture can open, e.g. an .avi or .mp4
+"""
+
+import cv2, cv
+import os
+import threading
+import time
+from collections import deque
+import recorder
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+PACES = ('realtime', 'fast')
+
+class FileSource(threading.Thread):
+    """
+    Decodes frames on a background thread, at most PREFETCH ahead of the reader
+    1. Frames are resized to the camera size on the decoding thread
+    2. In 'realtime' pace, read() blocks until each frame is due, and skips
+       frames that the next one has already overtaken, as a live camera would
+    3. In 'fast' pace, read() returns the next frame as soon as it is decoded
+    4. With LOOP, the source rewinds at its end; otherwise read() then fails, as a
+       VideoCapture does, and finished() becomes True
+    Subclasses yield (bgr, pts) from decode(), pts in seconds
+    """
+
+    def __init__(self, width=640, height=480, pace='realtime', loop=False, prefetch=8, fps=30.0, name='source'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        if pace not in PACES:
+            raise ValueError('pace must be one of %s' % ', '.join(PACES))
+        self.SHAPE = (height, width, 3)
+        self.PACE = pace
+        self.LOOP = loop
+        self.PREFETCH = max(1, prefetch)
+        self.PERIOD = 1.0 / fps if fps > 0 else 1.0 / 30
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.exhausted = False
+        self.start_time = None
+        self.first_pts = None
+        self.decoded = 0
+        self.delivered = 0
+        self.skipped = 0
+        self.loops = 0
+
+    def decode(self):
+        raise NotImplementedError
+
+    def rewind(self):
+        pass
+
+    ## Decode Loop
+    """
+    1. Decode and resize the next frame, waiting while PREFETCH frames are queued
+    2. At the end, rewind if looping, shifting the pts so they keep increasing
+    """
+    def run(self):
+        offset = 0.0
+        while self.running:
+            (first, last) = (None, None)
+            for (bgr, pts) in self.decode():
+                if bgr.shape != self.SHAPE:
+                    bgr = cv2.resize(bgr, (self.SHAPE[1], self.SHAPE[0]))
+                if first is None:
+                    first = pts
+                last = pts
+                with self.condition:
+                    while self.running and len(self.frames) >= self.PREFETCH:
+                        self.condition.wait(0.5)
+                    if not self.running:
+                        return
+                    self.frames.append((bgr, pts + offset))
+                    self.decoded += 1
+                    self.condition.notify_all()
+            if not self.LOOP or first is None:
+                break
+            offset += last - first + self.PERIOD
+            self.loops += 1
+            self.rewind()
+        with self.condition:
+            self.exhausted = True
+            self.condition.notify_all()
+
+    ## Read Frame
+    """
+    1. Wait for a decoded frame, failing once the source is exhausted
+    2. If pacing in realtime, skip the frames already overtaken, then wait until the next is due
+    Returns (success, bgr), as VideoCapture.read()
+    """
+    def read(self):
+        with self.condition:
+            while self.running and not self.frames and not self.exhausted:
+                self.condition.wait(0.5)
+            if not self.frames:
+                return (False, None)
+            if self.PACE == 'realtime':
+                if self.start_time is None:
+                    (self.start_time, self.first_pts) = (time.time(), self.frames[0][1])
+                while len(self.frames) > 1 and self.due(self.frames[1][1]) <= time.time():
+                    self.frames.popleft()
+                    self.skipped += 1
+                while self.running:
+                    wait = self.due(self.frames[0][1]) - time.time()
+                    if wait <= 0:
+                        break
+                    self.condition.wait(wait)
+            (bgr, pts) = self.frames.popleft()
+            self.delivered += 1
+            self.condition.notify_all()
+        return (True, bgr)
+
+    def due(self, pts):
+        return self.start_time + pts - self.first_pts
+
+    def finished(self):
+        return self.exhausted and not self.frames
+
+    def isOpened(self):
+        return self.running
+
+    def set(self, prop, value):
+        return False # the size is fixed by resizing, and the rest does not apply
+
+    def get_stats(self):
+        return {
+            'decoded' : self.decoded,
+            'delivered' : self.delivered,
+            'skipped' : self.skipped,
+            'loops' : self.loops
+        }
+
+    def release(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join(1.0)
+
+class VideoFile(FileSource):
+    """
+    A video file, paced by its frame rate
+    """
+
+    def __init__(self, path, width=640, height=480, pace='realtime', loop=False, prefetch=8, fps=None):
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError('cannot open video %s' % path)
+        fps = fps or self.capture.get(cv.CV_CAP_PROP_FPS) or 30.0
+        FileSource.__init__(self, width, height, pace, loop, prefetch, fps, 'source-%s' % os.path.basename(path))
+
+    def decode(self):
+        i = 0
+        while self.running:
+            (s, bgr) = self.capture.read()
+            if not s:
+                break
+            yield (bgr, i * self.PERIOD)
+            i += 1
+
+    def rewind(self):
+        self.capture.release()
+        self.capture = cv2.VideoCapture(self.path)
+
+    def release(self):
+        FileSource.release(self)
+        self.capture.release()
+
+class ImageDirectory(FileSource):
+    """
+    The images of a directory in name order, paced at a fixed frame rate
+    """
+
+    def __init__(self, path, width=640, height=480, pace='realtime', loop=False, prefetch=8, fps=None):
+        self.path = path
+        self.files = sorted(f for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not self.files:
+            raise IOError('no images in %s' % path)
+        FileSource.__init__(self, width, height, pace, loop, prefetch, fps or 30.0, 'source-%s' % os.path.basename(path.rstrip('/')))
+
+    def decode(self):
+        for (i, name) in enumerate(self.files):
+            if not self.running:
+                break
+            bgr = cv2.imread(os.path.join(self.path, name))
+            if bgr is not None:
+                yield (bgr, i * self.PERIOD)
+
+class RecordingSource(FileSource):
+    """
+    A FrameRecorder file, paced by its recorded timestamps
+    Frames are copied out of the mapping on the decoding thread, so its page faults are taken there
+    """
+
+    def __init__(self, path, width=640, height=480, pace='realtime', loop=False, prefetch=8, fps=None):
+        self.path = path
+        self.recording = recorder.Recording(path)
+        if not len(self.recording):
+            raise IOError('no frames in %s' % path)
+        if fps is None and len(self.recording) > 1:
+            fps = (len(self.recording) - 1) / max(self.recording.timestamp(len(self.recording) - 1) - self.recording.timestamp(0), 1e-3)
+        FileSource.__init__(self, width, height, pace, loop, prefetch, fps or 30.0, 'source-%s' % os.path.basename(path))
+
+    def decode(self):
+        for i in range(len(self.recording)):
+            if not self.running:
+                break
+            (bgr, timestamp, sequence) = self.recording.read(i)
+            yield (bgr.copy(), float(timestamp))
+
+    def release(self):
+        FileSource.release(self)
+        self.recording.close()
+
+## Device
+"""
+True if the camera is given as a device index (an int, or a string of digits)
+"""
+def is_device(spec):
+    return isinstance(spec, (int, long)) or (isinstance(spec, basestring) and spec.isdigit())
+
+## Open Source
+"""
+1. Picks the source type from the path
+2. Starts its decoding thread and returns it
+"""
+def open_source(path, width=640, height=480, pace='realtime', loop=False, prefetch=8, fps=None):
+    if os.path.isdir(path):
+        source = ImageDirectory(path, width, height, pace, loop, prefetch, fps)
+    elif path.endswith('.rec'):
+        source = RecordingSource(path, width, height, pace, loop, prefetch, fps)
+    else:
+        source = VideoFile(path, width, height, pace, loop, prefetch, fps)
+    source.start()
+    return source
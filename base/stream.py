@@ -0,0 +1,165 @@
+"""
+stream.py
+MJPEG preview served over HTTP, for watching the vehicle without an X display
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cv2
+import socket
+import threading
+import time
+import preview
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    1. / and /stream.mjpg send every new frame as multipart/x-mixed-replace
+    2. /snapshot.jpg sends the next frame as a single JPEG
+    A connected request counts as a client for as long as it is open
+    """
+
+    def do_GET(self):
+        stream = self.server.stream
+        if self.path not in ('/', '/stream.mjpg', '/snapshot.jpg'):
+            self.send_error(404)
+            return
+        stream.connect()
+        try:
+            if self.path == '/snapshot.jpg':
+                (frame_id, jpeg) = stream.next_frame(stream.frame_id, wait=5.0)
+                if jpeg is None:
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header('Cache-Control', 'no-cache, private')
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(jpeg)))
+                self.end_headers()
+                self.wfile.write(jpeg)
+                return
+            self.send_response(200)
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            self.end_headers()
+            (frame_id, jpeg) = stream.next_frame(stream.frame_id)
+            while jpeg is not None:
+                self.wfile.write('--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg))
+                self.wfile.write(jpeg)
+                self.wfile.write('\r\n')
+                stream.sent += 1
+                (frame_id, jpeg) = stream.next_frame(frame_id)
+        except (socket.error, IOError):
+            pass # client went away
+        finally:
+            stream.disconnect()
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except (socket.error, IOError):
+            pass # client went away
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except (socket.error, IOError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class Stream(preview.Preview):
+    """
+    The preview composite, JPEG-encoded on the preview thread and served from an HTTP thread
+    1. submit() drops every frame while no client is connected, so an unwatched stream costs nothing
+    2. Frames are encoded at most RATE times per second, once for all clients
+    3. Each client is sent the newest frame; slow clients skip frames instead of queueing them
+    Binds to localhost by default; use an SSH tunnel to watch from elsewhere
+    """
+
+    def __init__(self, width=640, height=480, cams=1, rate=10.0, host='127.0.0.1', port=8080, quality=70):
+        preview.Preview.__init__(self, width, height, cams, rate, window='stream')
+        self.setName('stream')
+        self.PARAMS = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        self.server = Server((host, port), Handler)
+        self.server.stream = self
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name='stream-http')
+        self.server_thread.daemon = True
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_id = 0
+        self.clients = 0
+        self.connections = 0
+        self.encoded = 0
+        self.sent = 0
+
+    def submit(self, imgs, masks=None, offsets=None, headings=None):
+        if not self.clients:
+            return False
+        return preview.Preview.submit(self, imgs, masks, offsets, headings)
+
+    def connect(self):
+        with self.condition:
+            self.clients += 1
+            self.connections += 1
+
+    def disconnect(self):
+        with self.condition:
+            self.clients -= 1
+
+    ## Next Frame
+    """
+    Blocks until a frame newer than frame_id is encoded, or for at most wait seconds
+    Returns (frame_id, jpeg), with jpeg None once the stream is stopped or the wait runs out
+    """
+    def next_frame(self, frame_id, wait=None):
+        deadline = time.time() + wait if wait is not None else None
+        with self.condition:
+            while self.running and self.frame_id == frame_id:
+                remaining = deadline - time.time() if deadline is not None else 1.0
+                if remaining <= 0:
+                    return (frame_id, None)
+                self.condition.wait(min(remaining, 1.0))
+            if not self.running:
+                return (frame_id, None)
+            return (self.frame_id, self.frame)
+
+    ## Output
+    """
+    Encodes the composite and wakes every client waiting for a frame
+    """
+    def open(self):
+        self.server_thread.start()
+
+    def show(self, composite):
+        (ok, jpeg) = cv2.imencode('.jpg', composite, self.PARAMS)
+        if not ok:
+            return
+        with self.condition:
+            self.frame = jpeg.tostring()
+            self.frame_id += 1
+            self.encoded += 1
+            self.condition.notify_all()
+
+    def idle(self):
+        pass
+
+    def shut(self):
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self):
+        stats = preview.Preview.get_stats(self)
+        stats.update({
+            'connections' : self.connections,
+            'clients' : self.clients,
+            'encoded' : self.encoded,
+            'sent' : self.sent
+        })
+        return stats
@@ -0,0 +1,243 @@
+"""
+timing.py
+Monotonic clock, fixed-bucket latency histograms and the loop scheduler
+"""
+
+import bisect
+import ctypes
+import ctypes.util
+import json
+import time
+
+## Monotonic Clock
+"""
+Python 2 has no time.monotonic, so CLOCK_MONOTONIC is read through libc,
+falling back to time.time where it is unavailable
+"""
+try:
+    from time import monotonic
+except ImportError:
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        _timespec = timespec()
+        def monotonic():
+            _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(_timespec))
+            return _timespec.tv_sec + _timespec.tv_nsec * 1e-9
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+## Bucket Edges
+"""
+Logarithmic edges (s), four per octave from 10 us to about 2.6 s
+"""
+BUCKETS = [10e-6 * 2 ** (i / 4.0) for i in range(73)]
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram
+    1. Recording is a bisect and three additions, no allocation
+    2. Percentiles are estimated as the upper edge of the bucket they fall in (at most the max)
+    """
+
+    def __init__(self, edges=BUCKETS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        target = q / 100.0 * self.count
+        cumulative = 0
+        for (i, n) in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= target and n > 0:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def summary(self):
+        return {
+            'count' : self.count,
+            'mean_ms' : 1000 * self.total / self.count if self.count else 0.0,
+            'p50_ms' : 1000 * self.percentile(50),
+            'p99_ms' : 1000 * self.percentile(99),
+            'max_ms' : 1000 * self.max
+        }
+
+class Profiler:
+    """
+    One Histogram per stage of the run-time loop
+
+        t = profiler.start()
+        ...
+        t = profiler.lap('capture', t)
+
+    Each lap costs one clock read and one record
+    """
+
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+        self.histograms = dict((s, Histogram()) for s in self.stages)
+
+    def start(self):
+        return monotonic()
+
+    ## Lap
+    """
+    1. Records the time since t against the stage
+    2. Returns the current time, to be passed to the next lap
+    """
+    def lap(self, stage, t):
+        now = monotonic()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+            self.stages.append(stage)
+        histogram.record(now - t)
+        return now
+
+    def summary(self):
+        return dict((s, self.histograms[s].summary()) for s in self.stages)
+
+    def report(self):
+        lines = ['%-10s %8s %9s %9s %9s %9s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+        for (stage, s) in [(s, self.histograms[s].summary()) for s in self.stages]:
+            lines.append('%-10s %8d %9.3f %9.3f %9.3f %9.3f' % (stage, s['count'], s['mean_ms'], s['p50_ms'], s['p99_ms'], s['max_ms']))
+        return '\n'.join(lines)
+
+    ## Dump
+    """
+    Writes the summary and raw bucket counts of every stage as JSON
+    """
+    def dump(self, path):
+        output = {
+            'edges' : self.histograms[self.stages[0]].edges if self.stages else BUCKETS,
+            'stages' : dict((s, dict(self.histograms[s].summary(), counts=self.histograms[s].counts)) for s in self.stages)
+        }
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+
+    def reset(self):
+        for h in self.histograms.values():
+            h.reset()
+
+class Scheduler:
+    """
+    Runs the loop to a fixed period of 1 / frequency (a frequency of 0 never waits)
+
+        scheduler.start()
+        while True:
+            ...
+            if scheduler.fits('display'):
+                ...
+            scheduler.wait()
+
+    1. Optional stages only run if their mean cost in the Profiler fits before the deadline
+    2. remaining() gives the time left for a stage that can wait, e.g. for vision results
+    3. wait() sleeps out the slack, or counts an overrun if the deadline has passed
+    4. Deadlines stay on the grid of periods until an overrun, which restarts
+       the grid from its end rather than squeezing the following iterations
+    """
+
+    def __init__(self, frequency=0, profiler=None):
+        self.PERIOD = 1.0 / frequency if frequency > 0 else 0.0
+        self.profiler = profiler
+        self.deadline = None
+        self.iterations = 0
+        self.overruns = 0
+        self.missed = 0
+        self.skipped = {}
+        self.slack = Histogram()
+        self.overrun = Histogram()
+
+    def start(self):
+        self.deadline = monotonic() + self.PERIOD
+
+    def cost(self, stage):
+        histogram = self.profiler.histograms.get(stage) if self.profiler else None
+        if histogram is not None and histogram.count:
+            return histogram.total / histogram.count
+        return 0.0
+
+    ## Fits
+    """
+    Returns True if the stage is expected to finish before the deadline,
+    otherwise counts it as skipped
+    """
+    def fits(self, stage):
+        if self.PERIOD == 0:
+            return True
+        if monotonic() + self.cost(stage) <= self.deadline:
+            return True
+        self.skipped[stage] = self.skipped.get(stage, 0) + 1
+        return False
+
+    ## Remaining
+    """
+    Seconds left before the deadline once the mean cost of the given stages
+    is set aside, never below zero; None if the loop is not paced
+    """
+    def remaining(self, stages=()):
+        if self.PERIOD == 0:
+            return None
+        return max(0.0, self.deadline - monotonic() - sum(self.cost(s) for s in stages))
+
+    ## Wait
+    """
+    1. Records the slack (or the overrun) of this iteration
+    2. Sleeps until the deadline and sets the next one a period later
+    3. After an overrun, the next deadline is a period from now
+    """
+    def wait(self):
+        self.iterations += 1
+        if self.PERIOD == 0:
+            return
+        now = monotonic()
+        slack = self.deadline - now
+        if slack >= 0:
+            self.slack.record(slack)
+            time.sleep(slack)
+            self.deadline += self.PERIOD
+        else:
+            self.overruns += 1
+            self.overrun.record(-slack)
+            self.missed += int(-slack / self.PERIOD)
+            self.deadline = now + self.PERIOD
+
+    def get_stats(self):
+        return {
+            'iterations' : self.iterations,
+            'overruns' : self.overruns,
+            'missed' : self.missed,
+            'skipped' : dict(self.skipped),
+            'slack' : self.slack.summary(),
+            'overrun' : self.overrun.summary()
+        }
+
+    def report(self):
+        stats = self.get_stats()
+        lines = ['%d iterations, %d overruns, %d missed periods' % (stats['iterations'], stats['overruns'], stats['missed'])]
+        lines.append('slack   p50 %7.3f ms  p99 %7.3f ms' % (stats['slack']['p50_ms'], stats['slack']['p99_ms']))
+        lines.append('overrun p50 %7.3f ms  max %7.3f ms' % (stats['overrun']['p50_ms'], stats['overrun']['max_ms']))
+        for (stage, count) in sorted(stats['skipped'].items()):
+            lines.append('skipped %-10s %d' % (stage, count))
+        return '\n'.join(lines)
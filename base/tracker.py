@@ -0,0 +1,144 @@
+"""
+tracker.py
+Constant-velocity Kalman tracking of the crop row between frames
+"""
+
+class ConstantVelocity:
+    """
+    Kalman filter of a position and its velocity, driven by white-noise acceleration
+    1. predict() advances the state to a time, and peek() reads it there without advancing
+    2. update() gates each measurement on its normalised innovation before correcting
+    3. After MAX_REJECTS consecutive outliers the filter restarts on the measurement
+    The 2x2 covariance is kept as three floats, so a step allocates nothing
+    """
+
+    def __init__(self, acceleration, noise, gate=3.0, max_rejects=5):
+        self.Q = acceleration ** 2 # process noise (units^2/s^4)
+        self.R = noise ** 2 # measurement noise (units^2)
+        self.GATE = gate ** 2
+        self.MAX_REJECTS = max_rejects
+        self.t = None
+        self.rejects = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.resets = 0
+
+    ## Reset
+    """
+    Restarts at the measured position, at rest, with a wide velocity uncertainty
+    """
+    def reset(self, z, t):
+        (self.x, self.v) = (float(z), 0.0)
+        (self.p00, self.p01, self.p11) = (self.R, 0.0, 100.0 * self.R)
+        self.t = t
+        self.rejects = 0
+
+    ## Predict
+    """
+    x = x + v dt and P = F P F' + Q(dt), for the time elapsed since the last step
+    """
+    def predict(self, t):
+        dt = t - self.t
+        if dt > 0:
+            self.x += self.v * dt
+            self.p00 += dt * (2 * self.p01 + dt * self.p11) + self.Q * dt ** 3 / 3.0
+            self.p01 += dt * self.p11 + self.Q * dt ** 2 / 2.0
+            self.p11 += self.Q * dt
+            self.t = t
+        return self.x
+
+    ## Peek
+    """
+    Position at time t, without advancing the filter
+    """
+    def peek(self, t):
+        return self.x + self.v * max(t - self.t, 0.0)
+
+    ## Update
+    """
+    1. Predict to the time of the measurement
+    2. Reject it if its innovation is beyond GATE standard deviations
+    3. Otherwise correct the state and covariance with the Kalman gain
+    Returns True if the measurement was used
+    """
+    def update(self, z, t):
+        if self.t is None:
+            self.reset(z, t)
+            return True
+        self.predict(t)
+        y = z - self.x
+        s = self.p00 + self.R
+        if y * y > self.GATE * s:
+            self.rejected += 1
+            self.rejects += 1
+            if self.rejects > self.MAX_REJECTS:
+                self.resets += 1
+                self.reset(z, t)
+                return True
+            return False
+        (k0, k1) = (self.p00 / s, self.p01 / s)
+        self.x += k0 * y
+        self.v += k1 * y
+        self.p11 -= k1 * self.p01
+        self.p01 *= 1 - k0
+        self.p00 *= 1 - k0
+        self.rejects = 0
+        self.accepted += 1
+        return True
+
+    def get_stats(self):
+        return {
+            'accepted' : self.accepted,
+            'rejected' : self.rejected,
+            'resets' : self.resets
+        }
+
+class RowTracker:
+    """
+    Tracks the row offset (px) and, when it is measured, its heading (rad)
+    1. update() is called once for every new vision result, with the time its frame was captured
+    2. predict() gives the row at any time in between, e.g. at each control step,
+       without advancing the filters, so they only step from measurement to measurement
+    3. The track is lost once no measurement has been accepted for MAX_AGE seconds
+    """
+
+    def __init__(self, offset_acceleration=200.0, offset_noise=10.0, heading_acceleration=0.5, heading_noise=0.02, gate=3.0, max_age=0.5):
+        self.offset = ConstantVelocity(offset_acceleration, offset_noise, gate)
+        self.heading = ConstantVelocity(heading_acceleration, heading_noise, gate)
+        self.MAX_AGE = max_age
+        self.last_accepted = None
+        self.last_heading = None
+
+    ## Update
+    """
+    1. Update the offset filter, and the heading filter if a heading is given
+    2. Returns True if the offset was accepted
+    """
+    def update(self, offset, t, heading=None):
+        if offset is None:
+            return False
+        accepted = self.offset.update(offset, t)
+        if accepted:
+            self.last_accepted = t
+        if heading is not None and self.heading.update(heading, t):
+            self.last_heading = t
+        return accepted
+
+    ## Predict
+    """
+    Returns the (offset, heading) of the row at time t, None where lost
+    """
+    def predict(self, t):
+        offset = None
+        heading = None
+        if self.last_accepted is not None and t - self.last_accepted <= self.MAX_AGE:
+            offset = self.offset.peek(t)
+        if self.last_heading is not None and t - self.last_heading <= self.MAX_AGE:
+            heading = self.heading.peek(t)
+        return (offset, heading)
+
+    def get_stats(self):
+        return {
+            'offset' : self.offset.get_stats(),
+            'heading' : self.heading.get_stats()
+        }
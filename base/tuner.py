@@ -0,0 +1,209 @@
+"""
+tuner.py
+Offline search for the colour thresholds over recorded frames
+
+Frames are read from FrameRecorder files and converted to HSV once; the
+conversions are shared with the worker processes by fork, so every
+candidate only costs an inRange and an offset search per frame.
+Labels are optional JSON of hand-measured offsets (px from the centre),
+keyed by recording file name and frame sequence number:
+
+    {"20150601_101500_cam0.rec" : {"120" : -14.0, "480" : 22.5}}
+"""
+
+import cv2
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import re
+import cvm
+import recorder
+
+PARAMETERS = ['HUE_MIN', 'HUE_MAX', 'SAT_MIN', 'VAL_MIN']
+LIMITS = {'HUE_MIN' : (0, 179), 'HUE_MAX' : (0, 179), 'SAT_MIN' : (0, 255), 'VAL_MIN' : (0, 255)}
+STEPS = {'HUE_MIN' : 8, 'HUE_MAX' : 8, 'SAT_MIN' : 32, 'VAL_MIN' : 32}
+
+class Samples:
+    """
+    Recorded frames prepared for scoring
+    1. HSV of every sampled frame, and its mean saturation and value (as plant_filter uses them)
+    2. The label of each frame (NaN where unlabelled)
+    3. The recording each frame came from, so that stability is only measured within one
+    """
+
+    def __init__(self, paths, labels=None, stride=5, max_frames=200):
+        labels = labels or {}
+        per_file = max(1, max_frames // max(1, len(paths)))
+        (self.hsv, self.sat_means, self.val_means, self.labels, self.sources) = ([], [], [], [], [])
+        for (source, path) in enumerate(paths):
+            recording = recorder.Recording(path)
+            marks = labels.get(os.path.basename(path), {})
+            try:
+                for i in range(0, len(recording), stride)[:per_file]:
+                    (bgr, timestamp, sequence) = recording.read(i)
+                    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+                    (hue_mean, sat_mean, val_mean, _) = cv2.mean(hsv)
+                    self.hsv.append(hsv)
+                    self.sat_means.append(sat_mean)
+                    self.val_means.append(val_mean)
+                    self.labels.append(float(marks.get(str(sequence), np.nan)))
+                    self.sources.append(source)
+            finally:
+                recording.close()
+        self.labels = np.array(self.labels)
+        self.sources = np.array(self.sources)
+        self.LABELLED = int(np.isfinite(self.labels).sum())
+        (self.HEIGHT, self.WIDTH) = self.hsv[0].shape[:2] if self.hsv else (0, 0)
+
+    def __len__(self):
+        return len(self.hsv)
+
+## Score
+"""
+1. Offset of every frame with the candidate thresholds
+2. Stability: mean absolute change of the offset between consecutive frames of a recording
+3. Agreement: mean absolute error against the labelled frames (a miss counts as half the width)
+4. Detection: fraction of frames found with at least the minimum confidence
+Returns the scores and their weighted total, lower is better
+"""
+def score(params, samples, finder, stability_weight=1.0, miss_penalty=100.0):
+    (w, h) = (samples.WIDTH, samples.HEIGHT)
+    finder.reset_tracking()
+    offsets = np.empty(len(samples))
+    detected = np.zeros(len(samples), bool)
+    upper = np.array([params['HUE_MAX'], params['SAT_MAX'], params['VAL_MAX']], np.uint8)
+    lower = np.empty(3, np.uint8)
+    mask = np.empty((h, w), np.uint8)
+    for (i, hsv) in enumerate(samples.hsv):
+        lower[:] = (params['HUE_MIN'], max(params['SAT_MIN'], samples.sat_means[i]), max(params['VAL_MIN'], samples.val_means[i]))
+        cv2.inRange(hsv, lower, upper, dst=mask)
+        offset = finder.find_offset(mask)
+        offsets[i] = np.nan if offset is None else offset
+        detected[i] = offset is not None and finder.confidences.get(0, 0.0) >= finder.fusion.MIN_CONFIDENCE
+    same = (samples.sources[1:] == samples.sources[:-1]) & detected[1:] & detected[:-1]
+    stability = float(np.abs(np.diff(offsets))[same].mean()) if same.any() else 0.0
+    labelled = ~np.isnan(samples.labels)
+    errors = np.where(detected, np.abs(offsets - samples.labels), w / 2.0)[labelled]
+    agreement = float(errors.mean()) if labelled.any() else 0.0
+    detection = float(detected.mean()) if len(samples) else 0.0
+    return {
+        'stability_px' : stability,
+        'agreement_px' : agreement,
+        'detection' : detection,
+        'labelled' : int(labelled.sum()),
+        'total' : agreement + stability_weight * stability + miss_penalty * (1 - detection)
+    }
+
+## Worker State
+"""
+Set by the pool initializer; with fork, the samples are inherited rather than pickled
+"""
+_state = {}
+
+def _initialize(samples, fixed, options):
+    _state['samples'] = samples
+    _state['fixed'] = fixed
+    _state['options'] = options
+    _state['finder'] = cvm.RowFinder(cams=0, verbose=False, width=samples.WIDTH, height=samples.HEIGHT,
+                                     threshold_percentile=fixed['THRESHOLD_PERCENTILE'],
+                                     offset_mode=fixed.get('OFFSET_MODE', 'full'),
+                                     fusion_min_confidence=fixed.get('FUSION_MIN_CONFIDENCE'))
+
+def _evaluate(candidate):
+    params = dict(_state['fixed'], **dict(candidate))
+    return (candidate, score(params, _state['samples'], _state['finder'], **_state['options']))
+
+class Tuner:
+    """
+    Searches the thresholds in PARAMETERS against recorded Samples on every core
+    1. Candidates are scored in parallel by a pool of forked workers
+    2. Scores are memoised, so a search never evaluates a candidate twice
+    3. grid_search() scores a full grid; coordinate_search() refines one parameter at a time
+    """
+
+    def __init__(self, samples, config, processes=None, stability_weight=1.0, miss_penalty=100.0):
+        self.config = config
+        fixed = dict((k, config[k]) for k in PARAMETERS + ['SAT_MAX', 'VAL_MAX', 'THRESHOLD_PERCENTILE'])
+        for k in ('OFFSET_MODE', 'FUSION_MIN_CONFIDENCE'):
+            if k in config:
+                fixed[k] = config[k]
+        options = {'stability_weight' : stability_weight, 'miss_penalty' : miss_penalty}
+        self.pool = multiprocessing.Pool(processes, _initialize, (samples, fixed, options))
+        self.scores = {}
+
+    ## Evaluate
+    """
+    Scores every candidate not scored yet, returns (params, score) of the best of them
+    """
+    def evaluate(self, candidates):
+        keys = [tuple(sorted(c.items())) for c in candidates]
+        missing = [k for k in set(keys) if k not in self.scores]
+        for (key, result) in self.pool.map(_evaluate, missing):
+            self.scores[key] = result
+        best = min(keys, key=lambda k: self.scores[k]['total'])
+        return (dict(best), self.scores[best])
+
+    def grid_search(self, grid):
+        names = sorted(grid)
+        candidates = [dict(zip(names, values)) for values in itertools.product(*[grid[n] for n in names])]
+        candidates = [c for c in candidates if c.get('HUE_MIN', 0) < c.get('HUE_MAX', 180)]
+        return self.evaluate(candidates)
+
+    ## Coordinate Search
+    """
+    1. Starting from the configured thresholds, try each parameter at -span..span steps
+       with the others held, and keep the best
+    2. When a round changes nothing, halve the steps
+    3. Stops after the given rounds, or once every step is below one
+    """
+    def coordinate_search(self, steps=None, span=2, rounds=8, verbose=True):
+        steps = dict(steps or STEPS)
+        current = dict((k, int(self.config[k])) for k in PARAMETERS)
+        (current, best) = self.evaluate([current])
+        for r in range(rounds):
+            changed = False
+            for name in PARAMETERS:
+                (low, high) = LIMITS[name]
+                candidates = []
+                for k in range(-span, span + 1):
+                    value = min(high, max(low, current[name] + k * steps[name]))
+                    candidate = dict(current, **{name : value})
+                    if candidate['HUE_MIN'] < candidate['HUE_MAX']:
+                        candidates.append(candidate)
+                (params, result) = self.evaluate(candidates)
+                if result['total'] < best['total']:
+                    (current, best, changed) = (params, result, True)
+            if verbose:
+                print('round %d: %s total %.2f' % (r, ' '.join('%s=%d' % (k, current[k]) for k in PARAMETERS), best['total']))
+            if not changed:
+                steps = dict((k, s // 2) for (k, s) in steps.items())
+                if max(steps.values()) < 1:
+                    break
+                steps = dict((k, max(1, s)) for (k, s) in steps.items())
+        return (current, best)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+## Write Profile
+"""
+Copies a config file with the tuned thresholds
+1. Only the values of the tuned keys are replaced in the text, so the rest of the file is unchanged
+2. Keys missing from the config are added before the closing brace
+"""
+def write_profile(path, params, config_path):
+    with open(config_path) as f:
+        text = f.read()
+    for (k, v) in sorted(params.items()):
+        (text, count) = re.subn(r'("%s"\s*:\s*)[^,\n}]+' % re.escape(k), lambda m: m.group(1) + json.dumps(v), text)
+        if count == 0:
+            text = re.sub(r'\s*}\s*$', lambda m: ',\n    "%s" : %s\n}\n' % (k, json.dumps(v)), text)
+    json.loads(text)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(text)
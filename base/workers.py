@@ -0,0 +1,223 @@
+"""
+workers.py
+Process-per-camera vision workers
+"""
+
+import cv2
+import mmap
+import multiprocessing
+import numpy as np
+import time
+
+class FrameRing:
+    """
+    Pre-allocated ring of frame slots in anonymous shared memory
+    1. The mmap is created before the worker forks, so both processes share it
+    2. Frames are copied into a slot in place and only the slot index is sent
+    A single-channel ring holds 2-D (height, width) frames, e.g. masks
+    """
+
+    def __init__(self, width=640, height=480, channels=3, slots=2):
+        self.SLOTS = slots
+        self.SHAPE = (height, width, channels) if channels > 1 else (height, width)
+        self.SLOT_SIZE = width * height * channels
+        self.buffer = mmap.mmap(-1, self.SLOT_SIZE * self.SLOTS)
+        self.frames = [np.frombuffer(self.buffer, np.uint8, self.SLOT_SIZE, i * self.SLOT_SIZE).reshape(self.SHAPE) for i in range(self.SLOTS)]
+
+    ## Write Frame
+    """
+    1. Copy the frame into the slot, resizing if the camera ignored the requested size
+    """
+    def write(self, slot, bgr):
+        frame = self.frames[slot]
+        if bgr.shape == self.SHAPE:
+            np.copyto(frame, bgr)
+        else:
+            cv2.resize(bgr, (self.SHAPE[1], self.SHAPE[0]), dst=frame)
+
+    def read(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        self.frames = []
+        self.buffer.close()
+
+class VisionWorker:
+    """
+    Runs plant_filter and find_offset for one camera in its own process
+    1. Frames are handed over through a FrameRing, and their masks come back
+       through a second ring, in the slot of the frame
+    2. Only (slot, timestamp, sequence) goes down the pipe
+    3. Only (slot, (offset, timestamp, sequence, confidence, heading, quality)) comes back
+    4. On shutdown, the worker sends back its RowFinder's camera statistics,
+       since every per-camera state lives in the worker process
+    """
+
+    def __init__(self, row_finder, cam_num, slots=2):
+        self.row_finder = row_finder
+        self.cam_num = cam_num
+        self.ring = FrameRing(row_finder.CAMERA_WIDTH, row_finder.CAMERA_HEIGHT, 3, slots)
+        self.masks = FrameRing(row_finder.CAMERA_WIDTH, row_finder.CAMERA_HEIGHT, 1, slots)
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.work, args=(child_conn,), name='vision-%d' % cam_num)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.next_slot = 0
+        self.pending = 0
+        self.last_sequence = None
+        self.result = (None, None, None, None, None, None)
+        self.result_slot = None
+        self.stats = None
+        self.submitted = 0
+        self.skipped = 0
+        self.completed = 0
+
+    ## Worker Loop
+    """
+    Executed in the child process until a None message arrives, which is
+    answered with the camera statistics
+    """
+    def work(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+                if message is None:
+                    conn.send(self.row_finder.get_camera_stats([self.cam_num]))
+                    break
+                (slot, timestamp, sequence) = message
+                bgr = self.ring.read(slot)
+                mask = self.row_finder.plant_filter(bgr, cam_num=self.cam_num)
+                self.masks.write(slot, mask)
+                offset = self.row_finder.find_offset(mask, cam_num=self.cam_num)
+                confidence = self.row_finder.confidences.get(self.cam_num)
+                heading = self.row_finder.headings.get(self.cam_num)
+                quality = self.row_finder.qualities.get(self.cam_num)
+                conn.send((slot, (offset, timestamp, sequence, confidence, heading, quality)))
+            except (KeyboardInterrupt, EOFError):
+                break
+            except Exception as error:
+                print('\tERROR in work(): %s' % str(error))
+                conn.send((None, (None, None, None, None, None, None)))
+
+    ## Submit Frame
+    """
+    1. Skip frames already submitted, or if every slot is still in use
+    2. Copy into the oldest free slot and notify the worker
+    """
+    def submit(self, bgr, timestamp, sequence):
+        if bgr is None or sequence == self.last_sequence:
+            return False
+        if self.pending >= self.ring.SLOTS:
+            self.skipped += 1
+            return False
+        slot = self.next_slot
+        self.ring.write(slot, bgr)
+        self.conn.send((slot, timestamp, sequence))
+        self.next_slot = (slot + 1) % self.ring.SLOTS
+        self.pending += 1
+        self.submitted += 1
+        self.last_sequence = sequence
+        return True
+
+    ## Poll Results
+    """
+    1. Drain every finished result, waiting up to timeout for the first one
+    2. Returns the newest (offset, timestamp, sequence, confidence, heading, quality)
+    """
+    def poll(self, timeout=0):
+        while self.pending > 0 and self.conn.poll(timeout):
+            (self.result_slot, self.result) = self.conn.recv()
+            self.pending -= 1
+            self.completed += 1
+            timeout = 0
+        return self.result
+
+    ## Result Mask
+    """
+    The mask of the newest result, valid until the next frame is submitted, or None
+    """
+    def mask(self):
+        if self.result_slot is None:
+            return None
+        return self.masks.read(self.result_slot)
+
+    def get_stats(self):
+        return {
+            'submitted' : self.submitted,
+            'skipped' : self.skipped,
+            'completed' : self.completed,
+            'pending' : self.pending
+        }
+
+    ## Close
+    """
+    1. Ask the worker to stop, and keep the camera statistics it sends back
+       after any results still in flight
+    2. Wait for it to exit, terminating it if it does not
+    """
+    def close(self, timeout=1.0):
+        try:
+            self.conn.send(None)
+            while self.conn.poll(timeout):
+                message = self.conn.recv()
+                if isinstance(message, dict):
+                    self.stats = message
+                    break
+        except Exception:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.ring.close()
+        self.masks.close()
+
+class VisionPool:
+    """
+    One VisionWorker per camera of a RowFinder
+    """
+
+    def __init__(self, row_finder, slots=2):
+        self.workers = [VisionWorker(row_finder, i, slots) for i in range(row_finder.NUM_CAMERAS)]
+
+    ## Process Frames
+    """
+    1. Submit each camera's (bgr, timestamp, sequence) to its worker (None skips the camera)
+    2. Wait up to timeout (s) in all for the workers to finish, in parallel,
+       or with a timeout of None, until every worker has a result for its frame
+    3. Returns the newest (offset, timestamp, sequence, confidence, heading, quality) of each camera
+    """
+    def process(self, frames, timeout=0.1):
+        for (worker, (bgr, timestamp, sequence)) in zip(self.workers, frames):
+            worker.submit(bgr, timestamp, sequence)
+        if timeout is None:
+            return [w.poll(None) for w in self.workers]
+        deadline = time.time() + timeout
+        return [w.poll(max(0.0, deadline - time.time())) for w in self.workers]
+
+    ## Result Masks
+    """
+    The mask of each camera's newest result, valid until the next process() call
+    """
+    def masks(self):
+        return [w.mask() for w in self.workers]
+
+    def get_stats(self):
+        return [w.get_stats() for w in self.workers]
+
+    ## Camera Statistics
+    """
+    The camera statistics the workers sent back on close, merged as
+    RowFinder.get_camera_stats returns them
+    """
+    def get_camera_stats(self):
+        stats = {}
+        for w in self.workers:
+            for (kind, cams) in (w.stats or {}).items():
+                stats.setdefault(kind, {}).update(cams)
+        return stats
+
+    def close(self):
+        for w in self.workers:
+            w.close()
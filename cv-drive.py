@@ -8,12 +8,14 @@ __version__ = '0.0.1'
 __license__ = 'All Rights Reserved'
 
 ## Libraries
-from base import control, gps, db, cvm
+from base import control, gps, db, cvm, workers, timing, tracker, preview, stream
+from collections import deque
 import json
 import numpy # Curve
 from matplotlib import pyplot as plt # Display
 import time 
 import sys
+import signal
 from datetime import datetime
 
 ## Settings file to use
@@ -29,8 +31,120 @@ class Vehicle:
         self.config = json.loads(open(config, 'rb').read())
         self.control = control.Arduino()
         self.gps = gps.GPS()
-        self.logger = db.Logger()
-        self.row_finder = cvm.RowFinder()
+        self.logger = db.Logger(
+            log_format=self.config['LOG_FORMAT'],
+            mongo_format=self.config['MONGO_FORMAT'],
+            time_format=self.config['TIME_FORMAT'],
+            verbose=self.config['VERBOSE']
+        )
+        self.row_finder = cvm.RowFinder(
+            cams=len(self.config['CAMERAS']),
+            verbose=self.config['VERBOSE'],
+            width=self.config['PIXEL_WIDTH'],
+            height=self.config['PIXEL_HEIGHT'],
+            depth=self.config['CAMERA_HEIGHT'],
+            fov=self.config['CAMERA_FOV'],
+            tilt=self.config.get('CAMERA_TILT', 0.0),
+            ground_remap=self.config.get('GROUND_REMAP', False),
+            threaded=self.config.get('THREADED_CAPTURE', False),
+            hue_min=self.config['HUE_MIN'],
+            hue_max=self.config['HUE_MAX'],
+            sat_min=self.config['SAT_MIN'],
+            sat_max=self.config['SAT_MAX'],
+            val_min=self.config['VAL_MIN'],
+            val_max=self.config['VAL_MAX'],
+            filter_mode=self.config.get('FILTER_MODE', 'hsv'),
+            lut_bits=self.config.get('LUT_BITS', 5),
+            cache_dir=self.config.get('CACHE_DIR', 'cache'),
+            threshold_percentile=self.config['THRESHOLD_PERCENTILE'],
+            offset_mode=self.config.get('OFFSET_MODE', 'full'),
+            roi_band=self.config.get('ROI_BAND', (0.5, 1.0)),
+            roi_window=self.config.get('ROI_WINDOW', 0.125),
+            roi_confidence=self.config.get('ROI_CONFIDENCE', 1.5),
+            record_dir=self.config.get('RECORD_DIR') if self.config.get('RECORD_ON', False) else None,
+            record_frames=self.config.get('RECORD_FRAMES', 600),
+            line_rows=self.config.get('LINE_ROWS', 3),
+            line_tolerance=self.config.get('LINE_TOLERANCE', 0.04),
+            line_lookahead=self.config.get('LINE_LOOKAHEAD', 0.5),
+            pyramid_scale=self.config.get('PYRAMID_SCALE', 4),
+            pyramid_window=self.config.get('PYRAMID_WINDOW', 0.125),
+            fusion_max_age=self.config.get('FUSION_MAX_AGE', 0.5),
+            fusion_min_confidence=self.config.get('FUSION_MIN_CONFIDENCE'),
+            camera_sources=self.config['CAMERAS'],
+            source_pace=self.config.get('SOURCE_PACE', 'realtime'),
+            source_loop=self.config.get('SOURCE_LOOP', False),
+            source_prefetch=self.config.get('SOURCE_PREFETCH', 8),
+            source_fps=self.config.get('SOURCE_FPS'),
+            quality_min_peak=self.config.get('QUALITY_MIN_PEAK', 2.0),
+            quality_min_coverage=self.config.get('QUALITY_MIN_COVERAGE', 0.01),
+            quality_max_band=self.config.get('QUALITY_MAX_BAND', 0.25),
+            adaptive_refresh=self.config.get('ADAPTIVE_REFRESH', 0),
+            adaptive_stride=self.config.get('ADAPTIVE_STRIDE', 4),
+            adaptive_alpha=self.config.get('ADAPTIVE_ALPHA', 0.3),
+            adaptive_jump=self.config.get('ADAPTIVE_JUMP', 25.0),
+            stripes=self.config.get('STRIPES', 1),
+            correlation_alpha=self.config.get('CORRELATION_ALPHA', 0.2),
+            correlation_max_shift=self.config.get('CORRELATION_MAX_SHIFT', 0.25),
+            correlation_min=self.config.get('CORRELATION_MIN', 0.5),
+            periodic_min_spacing=self.config.get('PERIODIC_MIN_SPACING', 0.2),
+            periodic_max_spacing=self.config.get('PERIODIC_MAX_SPACING', 0.8),
+            periodic_min_strength=self.config.get('PERIODIC_MIN_STRENGTH', 0.2)
+        )
+        self.QUALITY_GATE_ON = self.config.get('QUALITY_GATE_ON', True)
+        self.vision_frames = 0
+        self.gated_frames = 0
+        self.sequences = [None] * self.row_finder.NUM_CAMERAS # sequence of the last frame measured
+        if self.config.get('VISION_MODE', 'serial') == 'process':
+            self.vision_pool = workers.VisionPool(self.row_finder, self.config.get('VISION_SLOTS', 2))
+            self.VISION_TIMEOUT = self.config.get('VISION_TIMEOUT', 0.1) # s, at most, within the slack of the period
+        else:
+            self.vision_pool = None
+        if self.config.get('TRACKER_ON', False):
+            self.tracker = tracker.RowTracker(
+                offset_acceleration=self.config.get('TRACKER_ACCELERATION', 200.0),
+                offset_noise=self.config.get('TRACKER_NOISE', 10.0),
+                heading_acceleration=self.config.get('TRACKER_HEADING_ACCELERATION', 0.5),
+                heading_noise=self.config.get('TRACKER_HEADING_NOISE', 0.02),
+                gate=self.config.get('TRACKER_GATE', 3.0),
+                max_age=self.config.get('TRACKER_MAX_AGE', 0.5)
+            )
+        else:
+            self.tracker = None
+        self.VISION_DIVIDER = max(1, self.config.get('VISION_DIVIDER', 1))
+        self.CAMERA_DIVIDERS = [max(1, d) for d in self.config.get('CAMERA_DIVIDERS', [1] * self.row_finder.NUM_CAMERAS)]
+        self.previews = []
+        if self.config.get('DISPLAY_ON', False):
+            self.previews.append(preview.Preview(
+                width=self.config['PIXEL_WIDTH'],
+                height=self.config['PIXEL_HEIGHT'],
+                cams=self.row_finder.NUM_CAMERAS,
+                rate=self.config.get('PREVIEW_RATE', 10),
+                fullscreen=self.config.get('FULLSCREEN', False)
+            ))
+        if self.config.get('STREAM_ON', False):
+            self.previews.append(stream.Stream(
+                width=self.config['PIXEL_WIDTH'],
+                height=self.config['PIXEL_HEIGHT'],
+                cams=self.row_finder.NUM_CAMERAS,
+                rate=self.config.get('STREAM_RATE', 5),
+                host=self.config.get('STREAM_HOST', '127.0.0.1'),
+                port=self.config.get('STREAM_PORT', 8080),
+                quality=self.config.get('STREAM_QUALITY', 70)
+            ))
+        for p in self.previews:
+            p.start()
+        self.estimates = deque(maxlen=self.config['NUM_AVERAGES'])
+        self.profiler = timing.Profiler(['capture', 'filter', 'offset', 'estimate', 'control', 'log', 'display'])
+        self.FREE_RUNNING = self.row_finder.free_running() # fast file sources: every frame, unpaced
+        self.scheduler = timing.Scheduler(0 if self.FREE_RUNNING else self.config.get('FREQUENCY_LIMIT', 0), self.profiler)
+        signal.signal(signal.SIGUSR1, self.report_latency)
+
+    """
+    Function to print the per-stage latency histograms at run-time (kill -USR1 <pid>)
+    """
+    def report_latency(self, signum=None, frame=None):
+        print(self.profiler.report())
+        print(self.scheduler.report())
     
     """
     Function to shutdown application safely
@@ -44,26 +158,180 @@ class Vehicle:
         except Exception as error:
             print('\tERROR in close()\t%s' % str(error))
         try:
+            self.report_latency()
+            self.profiler.dump(self.config.get('LATENCY_FILE', 'logs/latency.json'))
+        except Exception as error:
+            print('\tERROR in close()\t%s' % str(error))
+        try:
+            if self.vision_pool:
+                self.vision_pool.close()
+                camera_stats = self.vision_pool.get_camera_stats()
+            else:
+                camera_stats = self.row_finder.get_camera_stats()
+            print('\tQuality gate: %d of %d frames skipped' % (self.gated_frames, self.vision_frames))
+            for (c, stats) in sorted(camera_stats.get('allocations', {}).items()):
+                print('\tBuffers %d: %d buffers, %d allocations, %d KB' % (c, stats['buffers'], stats['allocations'], stats['bytes'] // 1024))
+            for (c, stats) in sorted(camera_stats.get('roi', {}).items()):
+                print('\tROI %d: %d hits, %d misses, %d searches, %.2f of the pixels' % (c, stats['hits'], stats['misses'], stats['searches'], stats['pixel_ratio']))
+            for (c, stats) in sorted(camera_stats.get('correlation', {}).items()):
+                print('\tCorrelation %d: %d tracked, %d resets' % (c, stats['tracked'], stats['resets']))
+            for (c, stats) in sorted(camera_stats.get('spacing', {}).items()):
+                if stats['spacing'] is not None:
+                    print('\tRow spacing %d: %.1f px (%.1f cm), periodic in %d of %d frames' % (c, stats['spacing'], stats['spacing_cm'], stats['periodic'], stats['frames']))
+            for (c, stats) in sorted(camera_stats.get('adaptive', {}).items()):
+                print('\tAdaptive threshold %d: %d frames, %d refreshes, %d jumps' % (c, stats['frames'], stats['refreshes'], stats['jumps']))
+            for (c, stats) in sorted(self.row_finder.fusion.get_stats().items()):
+                print('\tFusion camera %d: %d used, %d stale, %d rejected' % (c, stats['used'], stats['stale'], stats['rejected']))
+            if self.tracker:
+                stats = self.tracker.get_stats()['offset']
+                print('\tTracker: %d accepted, %d rejected, %d resets' % (stats['accepted'], stats['rejected'], stats['resets']))
+            for p in self.previews:
+                stats = p.get_stats()
+                print('\t%s: %d drawn, %d dropped' % (p.getName().capitalize(), stats['drawn'], stats['dropped']))
+                p.stop()
+            for (i, stats) in sorted(self.row_finder.get_capture_stats().items()):
+                print('\tCamera %d: %d grabbed, %d dropped, %d repeated' % (i, stats['grabbed'], stats['dropped'], stats['repeated']))
+            for (i, camera) in enumerate(self.row_finder.cameras):
+                if hasattr(camera, 'get_stats'):
+                    stats = camera.get_stats()
+                    print('\tSource %d: %d decoded, %d delivered, %d skipped, %d loops' % (i, stats['decoded'], stats['delivered'], stats['skipped'], stats['loops']))
             self.row_finder.close()
         except Exception as error:
             print('ERROR in close()\t%s' % str(error))
         
     """
     Function for Run-time loop
+    1. Vision runs on every VISION_DIVIDER-th iteration, and each camera on
+       every CAMERA_DIVIDERS[c]-th of those; the fusion keeps its last offset in between
+    2. The heading is the fusion's confidence-weighted heading of the cameras behind the offset
+       If tracking, the tracker is updated once per new measurement, at the time its
+       newest frame was captured, and the controller is given the tracked row at every iteration;
+       otherwise, iterations without vision give it the last fused offset, until that is older
+       than FUSION_MAX_AGE, and none without an estimate reach it
+    3. Iterations are paced to FREQUENCY_LIMIT; logging and display are
+       skipped when they would miss the deadline
+    4. Frames are handed to the preview and stream threads, which drop what they cannot show
+    5. With file sources (see base/sources.py), stops once every source has ended; if they
+       are all in 'fast' pace, every frame is measured and the loop is not paced
+    6. A frame the grabber has already handed out is not measured again, nor is a vision
+       worker's result used twice; until a camera has a new one, the fusion keeps its last offset
+    7. If QUALITY_GATE_ON, frames below the QUALITY thresholds are not fused, and if no
+       camera's frame passes, the controller and logger are skipped for the iteration
+    8. However the loop ends, including Ctrl-C while waiting out the period, close() runs
     """     
     def run(self):
-        while True:
-            try:
-                cams = range(1)
-                imgs = [self.row_finder.capture_image(c) for c in cams]
-                masks = [self.row_finder.plant_filter(i) for i in imgs]
-                offsets = [self.row_finder.find_offset(m) for m in masks]
-                for m in imgs:
-                    self.row_finder.display(m)
-            except KeyboardInterrupt as error:
-                self.close()
-            except Exception as error:
-                print str(error)
+        cams = range(self.row_finder.NUM_CAMERAS)
+        profiler = self.profiler
+        scheduler = self.scheduler
+        iteration = 0
+        scheduler.start()
+        try:
+            while True:
+                try:
+                    t = profiler.start()
+                    vision = iteration % self.VISION_DIVIDER == 0
+                    active = [vision and (iteration // self.VISION_DIVIDER) % d == 0 for d in self.CAMERA_DIVIDERS]
+                    iteration += 1
+                    if vision and self.row_finder.sources_finished():
+                        print('[Sources Finished] %s' % datetime.strftime(datetime.now(), self.config['TIME_FORMAT']))
+                        break
+                    offsets = [None] * len(cams)
+                    timestamps = None
+                    confidences = None
+                    headings = None
+                    qualities = None
+                    imgs = []
+                    masks = None
+                    if vision:
+                        frames = [self.row_finder.capture_frame(c) if active[c] else (None, None, None) for c in cams]
+                        imgs = [f[0] for f in frames]
+                        t = profiler.lap('capture', t)
+                        if self.vision_pool:
+                            timeout = scheduler.remaining(('estimate', 'control'))
+                            if not self.FREE_RUNNING:
+                                timeout = self.VISION_TIMEOUT if timeout is None else min(timeout, self.VISION_TIMEOUT)
+                            results = self.vision_pool.process(frames, timeout)
+                            fresh = [r[2] is not None and r[2] != self.sequences[c] for (c, r) in zip(cams, results)]
+                            for c in cams:
+                                if fresh[c]:
+                                    self.sequences[c] = results[c][2]
+                            (offsets, timestamps, sequences, confidences, headings, qualities) = zip(*[r if fresh[c] else (None,) * 6 for (c, r) in zip(cams, results)])
+                            masks = [m if fresh[c] else None for (c, m) in zip(cams, self.vision_pool.masks())]
+                        else:
+                            fresh = [f[0] is not None and f[2] != self.sequences[c] for (c, f) in zip(cams, frames)]
+                            for c in cams:
+                                if fresh[c]:
+                                    self.sequences[c] = frames[c][2]
+                            masks = [self.row_finder.plant_filter(f[0], cam_num=c) if fresh[c] else None for (c, f) in zip(cams, frames)]
+                            t = profiler.lap('filter', t)
+                            offsets = [self.row_finder.find_offset(m, cam_num=c) if m is not None else None for (c, m) in zip(cams, masks)]
+                            timestamps = [f[1] for f in frames]
+                            headings = [self.row_finder.headings.get(c) if m is not None else None for (c, m) in zip(cams, masks)]
+                            qualities = [self.row_finder.qualities.get(c) if m is not None else None for (c, m) in zip(cams, masks)]
+                        t = profiler.lap('offset', t)
+                    accepted = offsets
+                    gated = False
+                    if vision and self.QUALITY_GATE_ON and any(fresh):
+                        accepted = [o if self.row_finder.check_quality(q) else None for (o, q) in zip(offsets, qualities)]
+                        gated = all(o is None for o in accepted)
+                        self.vision_frames += 1
+                        self.gated_frames += gated
+                    measured = self.row_finder.estimate_row(accepted, headings, timestamps, confidences) if vision and not gated else None
+                    heading = self.row_finder.fused_heading if measured is not None else None
+                    if self.tracker:
+                        now = timing.monotonic()
+                        stamps = [s for (s, o) in zip(timestamps or [], accepted) if s is not None and o is not None]
+                        if measured is not None and stamps:
+                            self.tracker.update(measured, now - max(time.time() - max(stamps), 0.0), heading)
+                        (estimate, heading) = self.tracker.predict(now)
+                    elif vision:
+                        estimate = measured
+                    else:
+                        estimate = self.row_finder.estimate_row(offsets)
+                        heading = self.row_finder.fused_heading
+                    if estimate is not None:
+                        self.estimates.append(estimate)
+                    average = numpy.mean(self.estimates) if self.estimates else None
+                    t = profiler.lap('estimate', t)
+                    if self.config.get('ARDUINO_ENABLED', False) and not gated and estimate is not None:
+                        self.control.write_output(estimate, average)
+                        t = profiler.lap('control', t)
+                    if (self.config.get('LOGFILE_ON', False) or self.config.get('MONGO_ON', False)) and not gated and scheduler.fits('log'):
+                        sample = self.sample(offsets, estimate, average, heading, measured)
+                        if self.config.get('LOGFILE_ON', False):
+                            self.logger.log_file(sample)
+                        if self.config.get('MONGO_ON', False):
+                            self.logger.log_db(sample)
+                        t = profiler.lap('log', t)
+                    if self.previews and imgs and scheduler.fits('display'):
+                        for p in self.previews:
+                            p.submit(imgs, masks, offsets, headings)
+                        t = profiler.lap('display', t)
+                except Exception as error:
+                    print str(error)
+                scheduler.wait()
+        except KeyboardInterrupt as error:
+            pass
+        finally:
+            self.close()
+
+    """
+    Function to build the log sample of one iteration
+    """
+    def sample(self, offsets, estimate, average, heading=None, measured=None):
+        return {
+            'time' : datetime.strftime(datetime.now(), self.config['TIME_FORMAT']),
+            'lat' : getattr(self.gps, 'latitude', 0),
+            'long' : getattr(self.gps, 'longitude', 0),
+            'speed' : getattr(self.gps, 'speed', 0),
+            'cam0' : offsets[0] if len(offsets) > 0 else None,
+            'cam1' : offsets[1] if len(offsets) > 1 else None,
+            'measured' : measured,
+            'heading' : heading,
+            'estimate' : estimate,
+            'average' : average,
+            'pwm' : getattr(self.control, 'pwm', None)
+        }
     
 ## Main
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+"""
+Benchmark for the RowFinder hot paths on synthetic field imagery
+
+Generates crop-row images at several resolutions, times plant_filter,
+find_offset, estimate_row and the full per-frame loop, and saves the
+results as JSON so that runs can be compared before and after a change.
+
+    python examples/benchmark.py --output before.json
+    python examples/benchmark.py --output after.json --compare before.json
+    python examples/benchmark.py --configs hsv,lut --resolutions 1280x720 --stripes 1,2,4
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import timeit
+from datetime import datetime
+import numpy as np
+import cv2
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from base import cvm
+
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720)]
+CONFIGS = {
+    'hsv' : {'filter_mode' : 'hsv'},
+    'lut' : {'filter_mode' : 'lut'},
+    'roi' : {'filter_mode' : 'hsv', 'offset_mode' : 'roi'},
+    'exg' : {'filter_mode' : 'exg'},
+    'exgr' : {'filter_mode' : 'exgr'},
+    'cive' : {'filter_mode' : 'cive'},
+    'lines' : {'filter_mode' : 'hsv', 'offset_mode' : 'lines'},
+    'ground' : {'filter_mode' : 'hsv', 'ground_remap' : True},
+    'pyramid' : {'filter_mode' : 'hsv', 'offset_mode' : 'pyramid'},
+    'adaptive' : {'filter_mode' : 'hsv', 'adaptive_refresh' : 10},
+    'lut-adaptive' : {'filter_mode' : 'lut', 'adaptive_refresh' : 10},
+    'correlate' : {'filter_mode' : 'hsv', 'offset_mode' : 'correlate'},
+    'periodic' : {'filter_mode' : 'hsv', 'offset_mode' : 'periodic'}
+}
+HUE_MIN = 45
+HUE_MAX = 120
+THRESHOLD_PERCENTILE = 95
+
+## Synthetic Image
+"""
+1. Brown soil with per-pixel noise
+2. Green crop rows at a fixed spacing, leaning slightly, with gaps between plants
+3. Returns the image and the true offset of the centre row (px)
+"""
+def synthetic_frame(width, height, offset, rng, spacing=0.45, lean=0.05):
+    soil = np.array([40, 60, 90], np.int16)
+    crop = np.array([40, 140, 50], np.int16)
+    img = soil + rng.randint(-25, 25, (height, width, 3))
+    (y, x) = np.mgrid[0:height, 0:width]
+    plants = np.zeros((height, width), bool)
+    half_width = 0.04 * width
+    for k in (-2, -1, 0, 1, 2):
+        center = width / 2.0 + offset + k * spacing * width + lean * (y - height / 2.0)
+        phase = rng.uniform(0, np.pi)
+        size = half_width * (0.3 + 0.7 * np.abs(np.sin(y * 8.0 / height + phase)))
+        plants |= np.abs(x - center) < size
+    img[plants] = crop + rng.randint(-30, 30, (plants.sum(), 3))
+    return (np.clip(img, 0, 255).astype(np.uint8), offset)
+
+def synthetic_frames(width, height, count=20, seed=0):
+    rng = np.random.RandomState(seed)
+    drift = np.cumsum(rng.normal(0, 0.005 * width, count))
+    return [synthetic_frame(width, height, d, rng) for d in drift]
+
+## Fixed mmap Threshold
+"""
+Stops glibc from raising its mmap threshold after large frees, so every
+buffer above 64 KB is a fresh mmap and its pages fault when first written
+"""
+def fix_mmap_threshold(size=64 * 1024):
+    M_MMAP_THRESHOLD = -3
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        return libc.mallopt(M_MMAP_THRESHOLD, size) == 1
+    except (OSError, AttributeError):
+        return False
+
+## Page Faults
+"""
+Minor page faults of this process; with a fixed mmap threshold, every
+frame-sized allocation shows up as roughly one fault per 4 KB page.
+Faults are counted in a separate child process, since fresh mappings for
+every buffer would otherwise slow down the timed runs
+"""
+def page_faults():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+## Time Stage
+"""
+1. Calls fn once per input, cycling through the inputs, after a warm-up
+2. Returns frames/sec and p50/p99 latency
+"""
+def time_stage(fn, inputs, frames, warmup=10):
+    for i in range(warmup):
+        fn(inputs[i % len(inputs)])
+    timer = timeit.default_timer
+    latencies = np.empty(frames)
+    start = timer()
+    for i in range(frames):
+        t = timer()
+        fn(inputs[i % len(inputs)])
+        latencies[i] = timer() - t
+    total = timer() - start
+    return {
+        'fps' : frames / total,
+        'p50_ms' : 1000 * np.percentile(latencies, 50),
+        'p99_ms' : 1000 * np.percentile(latencies, 99)
+    }
+
+## Allocations
+"""
+FrameBuffers allocations of every camera of the RowFinder so far; a
+steady-state stage should add none
+"""
+def allocations(row_finder):
+    return sum(s['allocations'] for s in row_finder.get_allocation_stats())
+
+def count_faults(fn, inputs, frames, warmup=3):
+    for i in range(warmup):
+        fn(inputs[i % len(inputs)])
+    faults = page_faults()
+    for i in range(frames):
+        fn(inputs[i % len(inputs)])
+    return float(page_faults() - faults) / frames
+
+## Benchmark Stages
+"""
+Builds (fn, inputs) for every stage of one RowFinder configuration at one
+resolution, and the mean offset error against the synthetic ground truth
+Returns (stages, error, row_finder)
+"""
+def build_stages(options, width, height, cache_dir):
+    row_finder = cvm.RowFinder(cams=0, verbose=False, width=width, height=height,
+                               hue_min=HUE_MIN, hue_max=HUE_MAX, threshold_percentile=THRESHOLD_PERCENTILE,
+                               cache_dir=cache_dir, **options)
+    samples = synthetic_frames(width, height)
+    images = [s[0] for s in samples]
+    masks = [row_finder.plant_filter(i).copy() for i in images] # the mask is a reused buffer
+    offsets = [row_finder.find_offset(m) for m in masks]
+    def loop(bgr):
+        mask = row_finder.plant_filter(bgr)
+        offset = row_finder.find_offset(mask)
+        return row_finder.estimate_row([offset], [row_finder.headings.get(0)])
+    stages = {
+        'plant_filter' : (row_finder.plant_filter, images),
+        'find_offset' : (row_finder.find_offset, masks),
+        'estimate_row' : (row_finder.estimate_row, [[o] for o in offsets]),
+        'loop' : (loop, images)
+    }
+    errors = [abs(loop(i) - o) for (i, o) in samples]
+    return (stages, float(np.mean(errors)), row_finder)
+
+## Fault Pass
+"""
+Runs in a child process with a fixed mmap threshold, before anything is timed
+"""
+def fault_pass(jobs, frames, cache_dir, queue):
+    fixed = fix_mmap_threshold()
+    faults = {}
+    for (key, options, width, height) in jobs:
+        (stages, error, row_finder) = build_stages(options, width, height, cache_dir)
+        faults[key] = dict((stage, count_faults(fn, inputs, frames)) for (stage, (fn, inputs)) in stages.items())
+    queue.put((fixed, faults))
+
+## Scaling
+"""
+Prints the loop frames/sec at every stripe count, and its speed-up over one stripe
+"""
+def scaling(results, jobs):
+    print('\n%-24s %8s %10s %8s' % ('config', 'stripes', 'loop fps', 'speedup'))
+    for (key, options, width, height) in jobs:
+        base = key.split('/')[0]
+        if base not in results:
+            continue
+        fps = results[key]['loop']['fps']
+        print('%-24s %8d %10.1f %8.2f' % (base, options.get('stripes', 1), fps, fps / results[base]['loop']['fps']))
+
+## Compare
+"""
+Prints the frames/sec ratio of every stage against a previous run,
+flagging stages that now allocate more work buffers per frame
+"""
+def compare(results, previous):
+    print('\n%-24s %-14s %10s %10s %8s' % ('config', 'stage', 'before', 'after', 'ratio'))
+    for (key, stages) in sorted(results.items()):
+        for (stage, stats) in sorted(stages.items()):
+            try:
+                before = previous[key][stage]
+            except KeyError:
+                continue
+            flag = ''
+            if stats.get('allocations_per_frame', 0) > before.get('allocations_per_frame', 0):
+                flag = '  allocations %.2f -> %.2f/frame' % (before.get('allocations_per_frame', 0), stats['allocations_per_frame'])
+            print('%-24s %-14s %10.1f %10.1f %8.2f%s' % (key, stage, before['fps'], stats['fps'], stats['fps'] / before['fps'], flag))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark RowFinder on synthetic imagery')
+    parser.add_argument('--frames', type=int, default=200, help='timed frames per stage')
+    parser.add_argument('--configs', default='hsv', help='comma-separated names from: %s' % ', '.join(sorted(CONFIGS)))
+    parser.add_argument('--resolutions', default=','.join('%dx%d' % r for r in RESOLUTIONS))
+    parser.add_argument('--cache', default='cache', help='lookup table cache directory')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='previous JSON output to compare against')
+    parser.add_argument('--stripes', default='1', help='comma-separated stripe counts, to measure scaling over threads')
+    args = parser.parse_args()
+    cv2.setNumThreads(1)
+    jobs = []
+    stripes = [int(s) for s in args.stripes.split(',')]
+    for name in args.configs.split(','):
+        for resolution in args.resolutions.split(','):
+            (width, height) = [int(v) for v in resolution.split('x')]
+            for n in stripes:
+                key = '%s@%s' % (name, resolution) if n == 1 else '%s@%s/%d' % (name, resolution, n)
+                jobs.append((key, dict(CONFIGS[name], stripes=n) if n != 1 else CONFIGS[name], width, height))
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=fault_pass, args=(jobs, min(args.frames, 50), args.cache, queue))
+    child.start()
+    (fixed, faults) = queue.get()
+    child.join()
+    results = {}
+    for (key, options, width, height) in jobs:
+        (stages, error, row_finder) = build_stages(options, width, height, args.cache)
+        results[key] = {}
+        for (stage, (fn, inputs)) in sorted(stages.items()):
+            allocated = allocations(row_finder)
+            stats = results[key][stage] = time_stage(fn, inputs, args.frames)
+            stats['faults_per_frame'] = faults[key][stage]
+            stats['allocations_per_frame'] = float(allocations(row_finder) - allocated) / args.frames
+            print('%-24s %-14s %8.1f fps  p50 %7.3f ms  p99 %7.3f ms  %6.1f faults/frame  %5.2f allocs/frame' % (key, stage, stats['fps'], stats['p50_ms'], stats['p99_ms'], stats['faults_per_frame'], stats['allocations_per_frame']))
+        results[key]['loop']['error_px'] = error
+        results[key]['loop']['allocations'] = allocations(row_finder)
+        print('%-24s %-14s %8.2f px mean offset error' % (key, 'error', error))
+    output = {
+        'time' : datetime.now().isoformat(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'opencv' : cv2.__version__,
+        'machine' : platform.machine(),
+        'frames' : args.frames,
+        'cpus' : multiprocessing.cpu_count(),
+        'fixed_mmap_threshold' : fixed,
+        'results' : results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=4, sort_keys=True)
+    if len(stripes) > 1:
+        scaling(results, jobs)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Offline colour-threshold tuner over recorded sessions
+
+Scores threshold candidates on frames from FrameRecorder files (RECORD_ON),
+for offset stability and agreement with labelled frames, and writes the
+best set as a config profile.
+
+    python examples/tune.py recordings/*.rec --labels labels.json --output configs/tuned.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from base import tuner
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune colour thresholds on recorded frames')
+    parser.add_argument('recordings', nargs='+', help='FrameRecorder files')
+    parser.add_argument('--labels', default=None, help='JSON of labelled offsets, see base/tuner.py')
+    parser.add_argument('--config', default='settings.json', help='config to start from and copy')
+    parser.add_argument('--output', default='configs/tuned.json', help='config profile to write')
+    parser.add_argument('--search', default='coordinate', choices=['coordinate', 'grid'])
+    parser.add_argument('--rounds', type=int, default=8, help='coordinate search rounds')
+    parser.add_argument('--stride', type=int, default=5, help='use every n-th recorded frame')
+    parser.add_argument('--frames', type=int, default=200, help='maximum frames over all recordings')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--stability-weight', type=float, default=1.0)
+    parser.add_argument('--miss-penalty', type=float, default=100.0)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = json.load(f)
+    labels = None
+    if args.labels:
+        with open(args.labels) as f:
+            labels = json.load(f)
+    start = time.time()
+    samples = tuner.Samples(args.recordings, labels, args.stride, args.frames)
+    print('%d frames (%d labelled) converted in %.1f s' % (len(samples), samples.LABELLED, time.time() - start))
+    search = tuner.Tuner(samples, config, args.processes, args.stability_weight, args.miss_penalty)
+    try:
+        (initial, baseline) = search.evaluate([dict((k, config[k]) for k in tuner.PARAMETERS)])
+        if args.search == 'grid':
+            grid = {
+                'HUE_MIN' : range(20, 80, 8),
+                'HUE_MAX' : range(80, 140, 8),
+                'SAT_MIN' : range(0, 256, 64),
+                'VAL_MIN' : range(0, 256, 64)
+            }
+            (params, best) = search.grid_search(grid)
+        else:
+            (params, best) = search.coordinate_search(rounds=args.rounds)
+    finally:
+        search.close()
+    for (name, result) in (('config', baseline), ('tuned', best)):
+        print('%-8s stability %6.2f px  agreement %6.2f px  detection %5.1f%%  total %7.2f' % (name, result['stability_px'], result['agreement_px'], 100 * result['detection'], result['total']))
+    print('%s, %d candidates in %.1f s' % (', '.join('%s %d' % (k, params[k]) for k in tuner.PARAMETERS), len(search.scores), time.time() - start))
+    tuner.write_profile(args.output, params, args.config)
+    print('Wrote %s' % args.output)
+
+if __name__ == '__main__':
+    main()